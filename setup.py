@@ -38,6 +38,14 @@ setuptools.setup(
         'google-cloud-firestore',
         'google-cloud-bigquery',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'orjson': ['orjson'],
+        'msgpack': ['msgpack'],
+        'parquet': ['pyarrow'],
+        'storage-write': ['pyarrow', 'google-cloud-bigquery-storage'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
@@ -0,0 +1,76 @@
+import os
+import json
+import asyncio
+import pytest
+from google.cloud import firestore
+from xialib_gcp import AsyncFirestoreDepositor
+
+
+@pytest.fixture(scope='module')
+def depositor():
+    depositor = AsyncFirestoreDepositor(db=firestore.AsyncClient(), max_concurrency=4)
+    yield depositor
+
+async def async_flow(depositor: AsyncFirestoreDepositor):
+    with open(os.path.join('.', 'input', 'person_complex', 'schema.json'), 'rb') as f:
+        field_data = json.loads(f.read().decode()).pop('columns')
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())
+    header = {'topic_id': 'test-001', 'table_id': 'async_data', 'age': '1', 'start_seq': '20201113222500000000',
+              'data_encode': 'flat', 'data_format': 'record', 'data_store': 'body'}
+    depositor.add_document(header, field_data)
+    for i in range(10):
+        header = {'topic_id': 'test-001', 'table_id': 'async_data', 'age': i + 2,
+                  'start_seq': '20201113222500000000'}
+        depositor.add_document(header, data_body[i * 10: (i + 1) * 10])
+    assert len(depositor.pending_writes) == 11
+    assert await depositor.commit()
+
+    # A chunked document and its chunks are queued as one write batch
+    header = {'topic_id': 'test-001', 'table_id': 'async_data', 'age': 12, 'start_seq': '20201113222500000000'}
+    depositor.size_limit = 8192
+    chunk_header = depositor.add_document(header, data_body)
+    depositor.size_limit = AsyncFirestoreDepositor.size_limit
+    assert chunk_header['data_chunks'] > 1
+    assert [write[0] for write in depositor.pending_writes] == ['batch']
+    assert await depositor.commit()
+    chunk_ref = await depositor.get_ref_by_merge_key(chunk_header['merge_key'])
+    assert await depositor.get_data_from_header(depositor.get_header_from_ref(chunk_ref)) == data_body
+
+    counter, doc_list = 0, list()
+    async for doc in depositor.get_stream_by_sort_key(status_list=['initial'], header_only=True):
+        doc_data = await depositor.get_data_from_header(depositor.get_header_from_ref(doc))
+        counter += len(doc_data)
+        doc_list.append(doc)
+    assert counter == 100 + len(data_body)
+
+    depositor.delete_documents(doc_list)
+    queued_writes = len(depositor.pending_writes)
+    header_dict = await depositor.inc_table_header(merged_size=10)
+    assert header_dict['merged_size'] == 10
+    assert len(depositor.pending_writes) == queued_writes
+    header_ref = await depositor.get_table_header()
+    assert depositor.get_header_from_ref(header_ref)['merged_size'] == 10
+
+    depositor.delete_documents([header_ref])
+    assert await depositor.commit()
+    assert await depositor.get_table_header() is None
+    assert not depositor.failed_writes
+
+def test_async_flow(depositor: AsyncFirestoreDepositor):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(async_flow(depositor))
+
+def test_exceptions():
+    with pytest.raises(TypeError):
+        depo = AsyncFirestoreDepositor(db=firestore.Client())
+    with pytest.raises(ValueError):
+        depo = AsyncFirestoreDepositor(db=firestore.AsyncClient(), counter_shards=4)
+    with pytest.raises(ValueError):
+        depo = AsyncFirestoreDepositor(db=firestore.AsyncClient(), cache_size=2 ** 20)
+    depo = AsyncFirestoreDepositor(db=firestore.AsyncClient())
+    with pytest.raises(NotImplementedError):
+        with depo.batch_write():
+            pass
+    with pytest.raises(NotImplementedError):
+        depo.get_data_stream_by_sort_key(['initial'])
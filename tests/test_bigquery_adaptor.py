@@ -1,10 +1,13 @@
+import io
 import os
 import time
+import random
 import json
 import pytest
 import google.auth
+from google.api_core.exceptions import BadRequest, Forbidden, ServiceUnavailable, TooManyRequests
 from google.cloud import bigquery
-from xialib_gcp import BigQueryAdaptor
+from xialib_gcp import BigQueryAdaptor, StorageWriteTransport
 
 with open(os.path.join('.', 'input', 'person_simple', 'schema.json'), encoding='utf-8') as fp:
     field_data = json.load(fp)
@@ -18,6 +21,69 @@ new_table_id = "..test_01.simple_person_2"
 sql_count = "SELECT COUNT(*) FROM `x-i-a-test.test_01.simple_person`"
 
 
+class StubTransport(StorageWriteTransport):
+    def __init__(self, fail_offsets=None):
+        self.calls = list()
+        self.fail_offsets = set() if fail_offsets is None else set(fail_offsets)
+
+    def create_stream(self, table_path: str, mode: str) -> str:
+        self.calls.append(('create', table_path, mode))
+        return table_path + '/streams/stub'
+
+    def append_rows(self, stream_name: str, arrow_schema: bytes, arrow_batches, offsets):
+        self.calls.append(('append', stream_name, offsets))
+        failed = {offset: ['stub error'] for offset in offsets if offset in self.fail_offsets}
+        self.fail_offsets.clear()
+        return failed
+
+    def finalize_stream(self, stream_name: str):
+        self.calls.append(('finalize', stream_name))
+
+    def commit_streams(self, table_path: str, stream_names):
+        self.calls.append(('commit', table_path, stream_names))
+        return []
+
+
+class StubJob:
+    def __init__(self, error=None):
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+
+
+class StubClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = list()
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class StubClient(bigquery.Client):
+    def __init__(self, insert_errors=None, load_error=None):
+        self.calls = list()
+        self.insert_errors = list() if insert_errors is None else list(insert_errors)
+        self.load_error = load_error
+
+    def load_table_from_file(self, file_obj, destination, location=None, job_config=None):
+        self.calls.append(('load', destination, job_config.source_format, file_obj.read()))
+        return StubJob(self.load_error)
+
+    def insert_rows_json(self, table, json_rows, row_ids=None):
+        self.calls.append(('insert', table, list(json_rows), list(row_ids)))
+        errors = self.insert_errors.pop(0) if self.insert_errors else []
+        if isinstance(errors, Exception):
+            raise errors
+        return errors
+
+
 @pytest.fixture(scope='module')
 def adaptor():
     conn = bigquery.Client()
@@ -40,6 +106,179 @@ def test_simple_flow(adaptor: BigQueryAdaptor):
     assert adaptor.load_log_data(new_table_id)
     adaptor.drop_table(table_id)
 
+def test_load_job(adaptor: BigQueryAdaptor):
+    assert adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    adaptor.load_row_threshold = 1
+    assert adaptor.insert_raw_data(table_id, field_data, data_02)
+    assert not adaptor.insert_raw_data(table_id, field_data, [{"id": "error"}])
+    adaptor.load_row_threshold = BigQueryAdaptor.load_row_threshold
+    adaptor.drop_table(table_id)
+
+def test_load_threshold():
+    client = StubClient()
+    stub_adaptor = BigQueryAdaptor(connection=client, project_id='dummy')
+    stub_adaptor.load_row_threshold = len(data_02)
+    assert stub_adaptor.insert_raw_data(table_id, field_data, data_02[:-1])
+    assert stub_adaptor.insert_raw_data(table_id, field_data, data_02)
+    assert [call[0] for call in client.calls] == ['insert', 'load']
+    assert client.calls[0][2] == data_02[:-1]
+    assert client.calls[1][1] == 'dummy.test_01.simple_person'
+    assert client.calls[1][2] == bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+    assert [json.loads(line) for line in client.calls[1][3].decode().split('\n')] == data_02
+    # Byte threshold: sizes of up to 100 lines are exact
+    client.calls.clear()
+    stub_adaptor.load_row_threshold = BigQueryAdaptor.load_row_threshold
+    stub_adaptor.load_byte_threshold = sum([len(json.dumps(line, ensure_ascii=False)) for line in data_02[:10]])
+    assert stub_adaptor.insert_raw_data(table_id, field_data, data_02[:9])
+    assert stub_adaptor.insert_raw_data(table_id, field_data, data_02[:10])
+    assert [call[0] for call in client.calls] == ['insert', 'load']
+    client.load_error = BadRequest('load error')
+    assert not stub_adaptor.insert_raw_data(table_id, field_data, data_02[:10])
+
+def test_load_parquet():
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    client = StubClient()
+    stub_adaptor = BigQueryAdaptor(connection=client, project_id='dummy', load_format='parquet')
+    stub_adaptor.load_row_threshold = 1
+    assert stub_adaptor.insert_raw_data(table_id, field_data, data_02)
+    assert client.calls[0][0] == 'load'
+    assert client.calls[0][2] == bigquery.SourceFormat.PARQUET
+    arrow_table = pyarrow.parquet.read_table(io.BytesIO(client.calls[0][3]))
+    assert arrow_table.column_names == [field['field_name'] for field in field_data] + ['_AGE', '_SEQ', '_NO', '_OP']
+    assert [{key: line[key] for key in data_02[i]} for i, line in enumerate(arrow_table.to_pylist())] == data_02
+
+def test_stream_retry(monkeypatch):
+    clock = StubClock()
+    monkeypatch.setattr(time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(time, 'sleep', clock.sleep)
+    monkeypatch.setattr(random, 'random', lambda: 1.0)
+    client = StubClient()
+    stub_adaptor = BigQueryAdaptor(connection=client, project_id='dummy')
+    stub_adaptor.stream_row_rate = 10
+    # Token bucket: the second 10 rows wait for one second
+    assert stub_adaptor.insert_raw_data(table_id, field_data, data_02[:10])
+    assert clock.sleeps == []
+    assert stub_adaptor.insert_raw_data(table_id, field_data, data_02[:10])
+    assert clock.sleeps == [1.0]
+    # Only the failed rows are sent again with their row ids, with exponential backoff on 429 / 5xx / quota 403
+    client.calls.clear()
+    clock.sleeps.clear()
+    client.insert_errors = [
+        [{'index': 1, 'errors': [{'reason': 'backendError'}]}, {'index': 3, 'errors': [{'reason': 'timeout'}]}],
+        TooManyRequests('rate limit'),
+        Forbidden('Quota exceeded'),
+        ServiceUnavailable('unavailable'),
+    ]
+    assert stub_adaptor.insert_raw_data(table_id, field_data, data_02[:10])
+    assert [len(call[2]) for call in client.calls] == [10, 2, 2, 2, 2]
+    row_ids = client.calls[0][3]
+    assert len(set(row_ids)) == 10
+    for call in client.calls[1:]:
+        assert call[2] == [data_02[1], data_02[3]]
+        assert call[3] == [row_ids[1], row_ids[3]]
+    assert clock.sleeps == [1.0, 1, 2, 4, 8]
+    # Errors not retried
+    client.calls.clear()
+    client.insert_errors = [Forbidden('Access denied'), [{'index': 0, 'errors': [{'reason': 'invalid'}]}]]
+    assert not stub_adaptor.insert_raw_data(table_id, field_data, data_02[:1])
+    assert not stub_adaptor.insert_raw_data(table_id, field_data, data_02[:1])
+    assert len(client.calls) == 2
+    client.insert_errors = [ServiceUnavailable('unavailable')] * (stub_adaptor.stream_max_retries + 1)
+    assert not stub_adaptor.insert_raw_data(table_id, field_data, data_02[:1])
+
+def test_concurrent_stream(adaptor: BigQueryAdaptor):
+    assert adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    adaptor.stream_slice_size = 100
+    assert adaptor.insert_raw_data(table_id, field_data, data_02)
+    adaptor.stream_slice_size = BigQueryAdaptor.stream_slice_size
+    adaptor.drop_table(table_id)
+
+def test_storage_write(adaptor: BigQueryAdaptor):
+    pytest.importorskip('pyarrow')
+    transport = StubTransport()
+    storage_adaptor = BigQueryAdaptor(connection=adaptor.connection, project_id=adaptor.project_id,
+                                      insert_engine='storage', write_mode='pending', write_transport=transport)
+    storage_adaptor.write_batch_rows = 400
+    assert storage_adaptor.insert_raw_data(table_id, field_data, data_02)
+    assert [call[0] for call in transport.calls] == ['create', 'append', 'finalize', 'commit']
+    assert [call[2] for call in transport.calls if call[0] == 'append'] == [[0, 400, 800]]
+
+def test_storage_write_retry(adaptor: BigQueryAdaptor):
+    pytest.importorskip('pyarrow')
+    transport = StubTransport(fail_offsets=[400])
+    storage_adaptor = BigQueryAdaptor(connection=adaptor.connection, project_id=adaptor.project_id,
+                                      insert_engine='storage', write_transport=transport)
+    storage_adaptor.write_batch_rows = 400
+    assert storage_adaptor.insert_raw_data(table_id, field_data, data_02)
+    assert [call[0] for call in transport.calls] == ['create', 'append', 'append', 'finalize']
+    assert [call[2] for call in transport.calls if call[0] == 'append'] == [[0, 400, 800], [400, 800]]
+    assert len(set([call[1] for call in transport.calls if call[0] == 'append'])) == 1
+
+def test_merge_upsert(adaptor: BigQueryAdaptor):
+    merge_adaptor = BigQueryAdaptor(connection=adaptor.connection, project_id=adaptor.project_id,
+                                    upsert_engine='merge')
+    assert merge_adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    merge_adaptor.merge_batch_rows = 400
+    assert merge_adaptor.upsert_data(table_id, field_data, data_02)
+    assert merge_adaptor.upsert_data(table_id, field_data, data_02)
+    delete_line = dict(data_02[0], _OP='D', _AGE=2)
+    assert merge_adaptor.upsert_data(table_id, field_data, [delete_line])
+    # The deleted key is kept as a tombstone, an older replay doesn't bring it back
+    assert merge_adaptor.upsert_data(table_id, field_data, data_02[0:1])
+    rows = list(adaptor.connection.query(sql_count + " WHERE IFNULL(_OP, '') != 'D'").result())
+    assert rows[0][0] == len(data_02) - 1
+    assert merge_adaptor.purge_deleted_rows(table_id, 2)
+    rows = list(adaptor.connection.query(sql_count).result())
+    assert rows[0][0] == len(data_02) - 1
+    newer_line = dict(data_02[1], last_name='Newer', _AGE=3)
+    assert merge_adaptor.upsert_data(table_id, field_data, [newer_line])
+    assert merge_adaptor.upsert_data(table_id, field_data, data_02[1:2])
+    sql_name = "SELECT last_name FROM `x-i-a-test.test_01.simple_person` WHERE id = {}".format(newer_line['id'])
+    rows = list(adaptor.connection.query(sql_name).result())
+    assert rows[0][0] == 'Newer'
+    merge_adaptor.drop_table(table_id)
+
+def test_table_layout(adaptor: BigQueryAdaptor):
+    layout_adaptor = BigQueryAdaptor(connection=adaptor.connection, project_id=adaptor.project_id,
+                                     partition_type='age', cluster_keys=True)
+    assert layout_adaptor.create_table(table_id, '20200101000000000000', {'age_partition_interval': 10}, field_data)
+    table = adaptor.connection.get_table(adaptor._get_table_id(table_id))
+    assert table.range_partitioning.field == '_AGE'
+    assert table.range_partitioning.range_.interval == 10
+    assert table.range_partitioning.range_.end == 10 * layout_adaptor.age_partition_count
+    assert table.clustering_fields == ['id', 'first_name', 'last_name']
+    layout_adaptor.drop_table(table_id)
+    assert layout_adaptor.create_table(table_id, '20200101000000000000', {'partition_type': 'ingestion',
+                                                                         'cluster_keys': False}, field_data)
+    table = adaptor.connection.get_table(adaptor._get_table_id(table_id))
+    assert table.time_partitioning.type_ == 'DAY'
+    assert table.clustering_fields is None
+    layout_adaptor.drop_table(table_id)
+
+def test_metadata_cache(adaptor: BigQueryAdaptor):
+    cached_adaptor = BigQueryAdaptor(connection=adaptor.connection, project_id=adaptor.project_id,
+                                     metadata_cache=True)
+    assert cached_adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    bq_table_id = cached_adaptor._get_table_id(table_id)
+    assert bq_table_id in cached_adaptor._get_known_tables(cached_adaptor._get_dataset_id(table_id))
+    assert cached_adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    assert cached_adaptor.alter_column(table_id, {'field_name': 'city', 'type_chain': ['int']},
+                                       {'field_name': 'city', 'type_chain': ['char', 'c_9']})
+    assert not cached_adaptor.alter_column(table_id, {'field_name': 'city', 'type_chain': ['char']},
+                                           {'field_name': 'city', 'type_chain': ['int']})
+    assert cached_adaptor.alter_column(table_id, {'field_name': 'id', 'type_chain': ['int']},
+                                       {'field_name': 'id', 'type_chain': ['int', 'ui_8']})
+    cached_adaptor.drop_table(table_id)
+    assert bq_table_id not in cached_adaptor._get_known_tables(cached_adaptor._get_dataset_id(table_id))
+    # A table created by another adaptor after the listing is dropped as well
+    assert adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    cached_adaptor.drop_table(table_id)
+    table_list = adaptor.connection.list_tables(cached_adaptor._get_dataset_id(table_id))
+    assert bq_table_id not in ['.'.join([item.project, item.dataset_id, item.table_id]) for item in table_list]
+    cached_adaptor.clear_metadata_cache()
+    assert cached_adaptor.known_datasets is None
+
 def test_escape_column_name(adaptor: BigQueryAdaptor):
     assert adaptor._escape_column_name(r"/TEST/Hello") == "_TEST_Hello"
     assert adaptor._escape_column_name(r"0Hello") == "_0Hello"
@@ -47,6 +286,78 @@ def test_escape_column_name(adaptor: BigQueryAdaptor):
     long_str = "".join([str(x) for x in range(100)])
     assert len(adaptor._escape_column_name(long_str)) == 128
 
+def test_column_plan(adaptor: BigQueryAdaptor):
+    simple_data = [{'id': 1, 'first_name': 'A', '_AGE': 2}]
+    assert adaptor._rename_columns(table_id, field_data, simple_data) is simple_data
+    escaped_data = adaptor._rename_columns(table_id, field_data, [{'id': 1, 'last-name': 'B', '0x': 3}])
+    assert escaped_data == [{'id': 1, 'last_name': 'B', '_0x': 3}]
+
+def test_wide_column_plan(adaptor: BigQueryAdaptor, monkeypatch):
+    wide_fields = [{'field_name': 'col-{}'.format(i), 'type_chain': ['char']} for i in range(200)]
+    wide_data = [{field['field_name']: 'x' for field in wide_fields} for _ in range(1000)]
+    escaped_names = list()
+    escape_column_name = adaptor._escape_column_name
+    monkeypatch.setattr(adaptor, '_escape_column_name', lambda name: escaped_names.append(name) or
+                        escape_column_name(name))
+    # Column names are escaped once per table and field list, not once per row
+    renamed_data = adaptor._rename_columns("..test_01.wide_table", wide_fields, wide_data)
+    assert len(escaped_names) == len(wide_fields) + 4
+    adaptor._rename_columns("..test_01.wide_table", wide_fields, wide_data)
+    assert len(escaped_names) == len(wide_fields) + 4
+    assert list(renamed_data[0]) == ['col_{}'.format(i) for i in range(200)]
+
+def test_ctrl_cache(adaptor: BigQueryAdaptor, tmp_path):
+    cache_file = str(tmp_path / 'ctrl.db')
+    cached_adaptor = BigQueryAdaptor(connection=adaptor.connection, project_id=adaptor.project_id,
+                                     ctrl_cache_file=cache_file)
+    assert cached_adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    ctrl_info = cached_adaptor.get_ctrl_info(table_id)
+    assert ctrl_info['TABLE_ID'] == table_id
+    assert cached_adaptor.ctrl_cache[table_id]['VERSION'] == ctrl_info['VERSION']
+    file_adaptor = BigQueryAdaptor(connection=adaptor.connection, project_id=adaptor.project_id,
+                                   ctrl_cache_file=cache_file)
+    assert file_adaptor.get_ctrl_info(table_id) == ctrl_info
+    assert file_adaptor.get_ctrl_info(table_id, refresh=True)['VERSION'] == ctrl_info['VERSION']
+    cached_adaptor.drop_table(table_id)
+    assert cached_adaptor.get_ctrl_info(table_id)['VERSION'] == ctrl_info['VERSION'] + 1
+    cached_adaptor.clear_ctrl_cache()
+    assert table_id not in cached_adaptor.ctrl_cache
+
+def test_ctrl_info_many(adaptor: BigQueryAdaptor):
+    assert adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    ctrl_infos = adaptor.get_ctrl_info_many([table_id, "..test_01.dummy_person"])
+    assert ctrl_infos["..test_01.dummy_person"] == {'SOURCE_ID': "..test_01.dummy_person"}
+    assert adaptor.set_ctrl_info_many({table_id: {'start_seq': '20200101000000000001'},
+                                       new_table_id: {'table_id': new_table_id}})
+    new_ctrl_infos = adaptor.get_ctrl_info_many([table_id, new_table_id])
+    assert new_ctrl_infos[table_id]['VERSION'] == ctrl_infos[table_id]['VERSION'] + 1
+    assert new_ctrl_infos[table_id]['START_SEQ'] == '20200101000000000001'
+    assert new_ctrl_infos[new_table_id]['TABLE_ID'] == new_table_id
+    adaptor.drop_table(table_id)
+    adaptor.drop_table(new_table_id)
+
+def test_log_compaction(adaptor: BigQueryAdaptor):
+    log_adaptor = BigQueryAdaptor(connection=adaptor.connection, project_id=adaptor.project_id,
+                                  log_table_suffix='_log')
+    assert log_adaptor.create_table(table_id, '20200101000000000000', {}, field_data)
+    log_table_id = log_adaptor.get_log_table_id(table_id)
+    assert log_table_id == table_id + '_log'
+    assert adaptor.get_log_table_id(table_id) == ''
+    log_table = adaptor.connection.get_table(adaptor._get_table_id(log_table_id))
+    assert log_table.time_partitioning.type_ == 'DAY'
+    # Streamed rows would only be moved once they leave the streaming buffer, a load job makes them movable at once
+    log_adaptor.load_row_threshold = 1
+    age_data = [dict(line, _AGE=line['id'] % 3 + 1) for line in data_02]
+    assert log_adaptor.insert_raw_data(log_table_id, field_data, age_data)
+    assert [line['_age'] for line in log_adaptor.get_log_info(table_id)] == [1, 2, 3]
+    assert log_adaptor.load_log_data(table_id, 1, 2)
+    assert [line['_age'] for line in log_adaptor.get_log_info(table_id)] == [3]
+    assert log_adaptor.load_log_data(table_id, start_age=3)
+    assert log_adaptor.get_log_info(table_id) == []
+    rows = list(adaptor.connection.query(sql_count).result())
+    assert rows[0][0] == len(data_02)
+    log_adaptor.drop_table(table_id)
+
 def test_dummy_log_func(adaptor: BigQueryAdaptor):
     assert adaptor.get_log_table_id('dummy') == ''
     assert adaptor.get_log_info('dummy') == []
@@ -54,4 +365,10 @@ def test_dummy_log_func(adaptor: BigQueryAdaptor):
 def test_exceptions(adaptor: BigQueryAdaptor):
     with pytest.raises(TypeError):
         adap = BigQueryAdaptor(connection=object(), project_id='dummy')
+    with pytest.raises(ValueError):
+        adap = BigQueryAdaptor(connection=adaptor.connection, project_id='dummy', insert_engine='error')
+    with pytest.raises(ValueError):
+        adap = BigQueryAdaptor(connection=adaptor.connection, project_id='dummy', upsert_engine='error')
+    with pytest.raises(ValueError):
+        adap = BigQueryAdaptor(connection=adaptor.connection, project_id='dummy', partition_type='error')
 
@@ -1,12 +1,88 @@
 import os
 import json
+import gzip
 import datetime
 import pytest
 from google.cloud import firestore
+from google.api_core.exceptions import ServiceUnavailable
 from xialib import BasicTranslator
 from xialib_gcp import FirestoreDepositor
 
 
+class RecordingFirestoreClient(firestore.Client):
+    """In-memory Firestore client which counts the round trips (single writes and batch commits)"""
+    def __init__(self):
+        self.documents, self.round_trips, self.fail_commit, self.id_counter = dict(), 0, False, 0
+
+    def collection(self, path):
+        return RecordingReference(self, path)
+
+    def batch(self):
+        return RecordingBatch(self)
+
+
+class RecordingReference:
+    def __init__(self, client, path):
+        self.client, self.path = client, path
+
+    def collection(self, name):
+        return RecordingReference(self.client, self.path + '/' + name)
+
+    def document(self, doc_id=None):
+        if doc_id is None:
+            self.client.id_counter += 1
+            doc_id = str(self.client.id_counter)
+        return RecordingReference(self.client, self.path + '/' + doc_id)
+
+    def _apply(self, operation, content=None):
+        if operation == 'delete':
+            self.client.documents.pop(self.path, None)
+        elif operation in ['update', 'merge']:
+            self.client.documents.setdefault(self.path, dict()).update(content)
+        else:
+            self.client.documents[self.path] = dict(content)
+
+    def _call(self, operation, content=None):
+        self.client.round_trips += 1
+        self._apply(operation, content)
+
+    def create(self, content):
+        self._call('create', content)
+
+    def set(self, content, merge=False):
+        self._call('merge' if merge else 'set', content)
+
+    def update(self, content):
+        self._call('update', content)
+
+    def delete(self):
+        self._call('delete')
+
+
+class RecordingBatch:
+    def __init__(self, client):
+        self.client, self.operations = client, list()
+
+    def create(self, doc_ref, content):
+        self.operations.append((doc_ref, 'create', content))
+
+    def set(self, doc_ref, content, merge=False):
+        self.operations.append((doc_ref, 'merge' if merge else 'set', content))
+
+    def update(self, doc_ref, content):
+        self.operations.append((doc_ref, 'update', content))
+
+    def delete(self, doc_ref):
+        self.operations.append((doc_ref, 'delete', None))
+
+    def commit(self):
+        self.client.round_trips += 1
+        if self.client.fail_commit:
+            raise ServiceUnavailable("Fake commit failure")
+        for doc_ref, operation, content in self.operations:
+            doc_ref._apply(operation, content)
+
+
 @pytest.fixture(scope='module')
 def depositor():
     depositor = FirestoreDepositor(db=firestore.Client())
@@ -125,6 +201,43 @@ def test_merge_aged_simple(depositor: FirestoreDepositor):
     assert counter == 266
     assert total_size == header_dict['merged_size']
 
+def test_data_stream(depositor: FirestoreDepositor):
+    depositor.set_current_topic_table('test-001', 'aged_data')
+    sort_key_list, counter = list(), 0
+    for doc, doc_dict, doc_data in depositor.get_data_stream_by_sort_key(status_list=['merged'],
+                                                                         page_size=3):
+        sort_key_list.append(doc_dict['sort_key'])
+        counter += len(doc_data)
+        assert doc_data == depositor.get_data_from_header(depositor.get_header_from_ref(doc))
+    assert sort_key_list == sorted(sort_key_list)
+    assert counter == 266
+
+def test_server_level_filter(depositor: FirestoreDepositor):
+    depositor.set_current_topic_table('test-001', 'aged_data')
+    server_depositor = FirestoreDepositor(db=depositor.db, server_level_filter=True)
+    server_depositor.set_current_topic_table('test-001', 'aged_data')
+    server_depositor.migrate_merge_levels()
+    assert server_depositor.migrate_merge_levels() == 0
+    for level in range(3, 5):
+        client_list = [doc.id for doc in depositor.get_stream_by_sort_key(min_merge_level=level)]
+        server_list = [doc.id for doc in server_depositor.get_stream_by_sort_key(min_merge_level=level)]
+        assert client_list == server_list
+    for doc in depositor.get_stream_by_sort_key(status_list=['merged'], select=['merge_key', 'data_size']):
+        doc_dict = depositor.get_header_from_ref(doc)
+        assert 'data' not in doc_dict
+        assert 'merge_key' in doc_dict
+
+def test_header_only(depositor: FirestoreDepositor):
+    depositor.set_current_topic_table('test-001', 'aged_data')
+    for doc in depositor.get_stream_by_sort_key(status_list=['merged'], header_only=True):
+        doc_dict = depositor.get_header_from_ref(doc)
+        assert 'data' not in doc_dict
+        doc_data = depositor.get_data_from_header(doc_dict)
+        assert doc_dict['line_nb'] == len(doc_data)
+        assert depositor.get_data_from_header(doc_dict.copy()) == doc_data
+    header_ref = depositor.get_table_header(header_only=True)
+    assert 'data' not in depositor.get_header_from_ref(header_ref)
+
 def test_diverse_items(depositor: FirestoreDepositor):
     depositor.set_current_topic_table('test-001', 'aged_data')
     assert depositor._get_filter_key('packaged', 8) == 8
@@ -155,6 +268,208 @@ def test_delete_all_documents(depositor: FirestoreDepositor):
     for doc in depositor.get_stream_by_sort_key():
         depositor.delete_documents([doc])
 
+def test_batch_write(depositor: FirestoreDepositor):
+    depositor.set_current_topic_table('test-001', 'batch_data')
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())
+    depositor.batch_limit = 2
+    with depositor.batch_write():
+        for i in range(3):
+            header = {'topic_id': 'test-001', 'table_id': 'batch_data', 'age': i + 2,
+                      'start_seq': '20201113222500000000'}
+            depositor.add_document(header, data_body[i * 10: (i + 1) * 10])
+    depositor.batch_limit = 500
+    doc_list = [doc for doc in depositor.get_stream_by_sort_key(status_list=['initial'])]
+    assert len(doc_list) == 3
+    with depositor.batch_write():
+        depositor.delete_documents(doc_list)
+        assert len(depositor.batch_paths) == 3
+    assert not depositor.failed_writes
+    assert depositor.get_ref_by_merge_key(doc_list[0].to_dict()['merge_key']) is None
+
+def test_cached_header(depositor: FirestoreDepositor):
+    cached_depositor = FirestoreDepositor(db=depositor.db, cache_size=2 ** 24, cache_ttl=60)
+    add_normal_header(cached_depositor)
+    cached_depositor.set_current_topic_table('test-001', 'person_complex')
+    header_ref = cached_depositor.get_table_header()
+    assert cached_depositor.get_table_header() is header_ref
+    header_dict = cached_depositor.get_header_from_ref(header_ref)
+    header_data = cached_depositor.get_data_from_header(header_dict)
+    assert cached_depositor.get_data_from_header(header_dict) == header_data
+    header_dict = cached_depositor.inc_table_header(merged_size=10)
+    assert header_dict['merged_size'] == 10
+    new_header_ref = cached_depositor.get_table_header()
+    assert new_header_ref is not header_ref
+    assert cached_depositor.get_header_from_ref(new_header_ref)['merged_size'] == 10
+    # A header read before the batch is committed is not kept in the cache
+    with cached_depositor.batch_write():
+        cached_depositor.inc_table_header(merged_size=5)
+        assert cached_depositor.get_header_from_ref(cached_depositor.get_table_header())['merged_size'] == 10
+    new_header_ref = cached_depositor.get_table_header()
+    assert cached_depositor.get_header_from_ref(new_header_ref)['merged_size'] == 15
+    cached_depositor.delete_documents([new_header_ref])
+    assert cached_depositor.get_table_header() is None
+
+def test_payload_codec(depositor: FirestoreDepositor):
+    raw_depositor = FirestoreDepositor(db=depositor.db, codec='raw', serializer='json')
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())[:100]
+    header = {'topic_id': 'test-001', 'table_id': 'codec_data', 'age': 2, 'start_seq': '20201113222500000000'}
+    raw_depositor.add_document(header, data_body)
+    depositor.set_current_topic_table('test-001', 'codec_data')
+    for doc in depositor.get_stream_by_sort_key(status_list=['initial']):
+        doc_dict = depositor.get_header_from_ref(doc)
+        assert doc_dict['data_encode'] == 'raw'
+        assert depositor.get_data_from_header(doc_dict) == data_body
+        assert raw_depositor.get_data_from_header(doc_dict) == data_body
+        depositor.delete_documents([doc])
+
+def test_chunked_document(depositor: FirestoreDepositor):
+    chunk_depositor = FirestoreDepositor(db=depositor.db)
+    chunk_depositor.size_limit = 8192
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())
+    header = {'topic_id': 'test-001', 'table_id': 'chunk_data', 'age': 2, 'start_seq': '20201113222500000000'}
+    content = chunk_depositor.add_document(header, data_body)
+    assert content['data_chunks'] > 1
+    for doc in chunk_depositor.get_stream_by_sort_key(status_list=['initial'], header_only=True):
+        doc_dict = chunk_depositor.get_header_from_ref(doc)
+        assert chunk_depositor.get_data_from_header(doc_dict) == data_body
+        for _, _, doc_data in chunk_depositor.get_data_stream_by_sort_key(status_list=['initial']):
+            assert doc_data == data_body
+        chunk_depositor._update_document(doc, doc_dict, gzip.compress(json.dumps(data_body[:10]).encode()))
+    for doc in chunk_depositor.get_stream_by_sort_key(status_list=['initial']):
+        doc_dict = chunk_depositor.get_header_from_ref(doc)
+        assert 'data_chunks' not in doc_dict
+        assert chunk_depositor.get_data_from_header(doc_dict) == data_body[:10]
+        assert len([chunk for chunk in doc.reference.collection('chunks').stream()]) == 0
+        chunk_depositor.delete_documents([doc])
+
+def test_iter_data(depositor: FirestoreDepositor):
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())[:100]
+    header = {'topic_id': 'test-001', 'table_id': 'iter_data', 'age': 2, 'start_seq': '20201113222500000000'}
+    for serializer in ['json', 'ndjson']:
+        iter_depositor = FirestoreDepositor(db=depositor.db, serializer=serializer)
+        iter_depositor.add_document(header, data_body)
+        for doc in iter_depositor.get_stream_by_sort_key(status_list=['initial']):
+            doc_dict = iter_depositor.get_header_from_ref(doc)
+            assert [record for record in iter_depositor.iter_data_from_header(doc_dict, 256)] == data_body
+            assert iter_depositor.get_data_from_header(doc_dict) == data_body
+            iter_depositor.delete_documents([doc])
+
+def test_sharded_counter(depositor: FirestoreDepositor):
+    shard_depositor = FirestoreDepositor(db=depositor.db, counter_shards=4, counter_ttl=60)
+    add_normal_header(shard_depositor)
+    shard_depositor.set_current_topic_table('test-001', 'person_complex')
+    for i in range(10):
+        header_dict = shard_depositor.inc_table_header(merged_size=10, packaged_size=1)
+    assert header_dict['merged_size'] == 100
+    assert header_dict['packaged_size'] == 10
+    header_ref = shard_depositor.get_table_header()
+    assert 'merged_size' not in header_ref.to_dict()
+    shard_depositor.counter_cache.clear()
+    assert shard_depositor.get_header_from_ref(header_ref)['merged_size'] == 100
+    shard_depositor.delete_documents([header_ref])
+    assert len([shard for shard in header_ref.reference.collection('counters').stream()]) == 0
+
 def test_exceptions():
     with pytest.raises(TypeError):
-        depo = FirestoreDepositor(db=object())
\ No newline at end of file
+        depo = FirestoreDepositor(db=object())
+    with pytest.raises(ValueError):
+        depo = FirestoreDepositor(db=firestore.Client(), codec='error')
+
+def test_batch_round_trips():
+    db = RecordingFirestoreClient()
+    fake_depositor = FirestoreDepositor(db=db)
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())[:10]
+    headers = [{'topic_id': 'test-001', 'table_id': 'batch_data', 'age': i + 2, 'start_seq': '20201113222500000000'}
+               for i in range(10)]
+    for header in headers:
+        fake_depositor.add_document(header, data_body)
+    assert db.round_trips == 10
+    with fake_depositor.batch_write():
+        for header in headers:
+            fake_depositor.add_document(header, data_body)
+    assert db.round_trips == 11
+    fake_depositor.batch_limit = 4
+    with fake_depositor.batch_write():
+        for header in headers:
+            fake_depositor.add_document(header, data_body)
+    assert db.round_trips == 14
+    assert len(db.documents) == 30
+    # Batches following a failed one are dropped and the error is raised at exit
+    db.fail_commit = True
+    round_trips = db.round_trips
+    with pytest.raises(ServiceUnavailable):
+        with fake_depositor.batch_write():
+            for header in headers[:8]:
+                fake_depositor.add_document(header, data_body)
+    assert len(fake_depositor.failed_writes) == 8
+    assert db.round_trips == round_trips + 1
+    # Failures are only reported for the current batch context
+    db.fail_commit = False
+    with fake_depositor.batch_write():
+        fake_depositor.add_document(headers[0], data_body)
+    assert not fake_depositor.failed_writes
+    # Batches are also committed by bytes
+    fake_depositor.batch_limit = 500
+    write_size = fake_depositor._get_write_size(db.collection('test-001').document('1'), db.documents['test-001/1'])
+    fake_depositor.batch_byte_limit = int(write_size * 2.5)
+    with fake_depositor.batch_write():
+        for header in headers[:6]:
+            fake_depositor.add_document(header, data_body)
+            assert len(fake_depositor.batch_paths) <= 2
+    assert db.round_trips == round_trips + 5
+
+def test_chunk_group_write():
+    db = RecordingFirestoreClient()
+    fake_depositor = FirestoreDepositor(db=db)
+    fake_depositor.size_limit = 8192
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())
+    header = {'topic_id': 'test-001', 'table_id': 'chunk_data', 'age': 2, 'start_seq': '20201113222500000000'}
+    content = fake_depositor.add_document(header, data_body)
+    assert db.round_trips == 1
+    assert len(db.documents) == content['data_chunks']
+    # The pending batch is committed before a group which doesn't fit in it
+    fake_depositor.batch_limit = content['data_chunks'] + 1
+    with fake_depositor.batch_write():
+        fake_depositor.add_document(header, data_body[:10])
+        fake_depositor.add_document(header, data_body[:10])
+        fake_depositor.add_document(header, data_body)
+        assert len(fake_depositor.batch_paths) == content['data_chunks']
+    assert db.round_trips == 3
+    # A group larger than batch_byte_limit is committed by several batches, the document is written last
+    db.fail_commit = False
+    db.round_trips, db.documents = 0, dict()
+    fake_depositor.batch_byte_limit = 3 * 8192
+    content = fake_depositor.add_document(header, data_body)
+    assert db.round_trips > 1
+    assert len(db.documents) == content['data_chunks']
+    assert all([len(chunk) <= 8192 * fake_depositor.chunk_fill_rate for chunk in
+                [doc['data'] for doc in db.documents.values()]])
+    db.fail_commit = True
+    with pytest.raises(ServiceUnavailable):
+        fake_depositor.add_document(header, data_body)
+
+def test_encode_once(monkeypatch):
+    db = RecordingFirestoreClient()
+    fake_depositor = FirestoreDepositor(db=db, codec='raw', serializer='ndjson')
+    fake_depositor.size_limit = 8192
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())
+    header = {'topic_id': 'test-001', 'table_id': 'encode_data', 'age': 2, 'start_seq': '20201113222500000000'}
+    # The payload is encoded from the given records, the gzip json payload of depositor is never parsed
+    monkeypatch.setattr(gzip, 'decompress', lambda data: pytest.fail('payload transcoded'))
+    content = fake_depositor.add_document(header, data_body)
+    assert content['data_encode'] == 'raw+ndjson'
+    assert content['data_chunks'] > 1
+    chunk_list = [doc['data'] for doc in db.documents.values()]
+    assert sum([len(chunk.split(b'\n')) for chunk in chunk_list]) == len(data_body)
+
+def test_header_fields():
+    fake_depositor = FirestoreDepositor(db=RecordingFirestoreClient(), header_fields=['meta_data', 'age'])
+    assert fake_depositor.header_fields == FirestoreDepositor.header_fields + ['meta_data']
+    assert 'meta_data' not in FirestoreDepositor.header_fields
@@ -1,8 +1,79 @@
+import io
 import os
+import sys
+import subprocess
+import threading
 import pytest
 from xialib_gcp import GCSStorer
 
 
+class RecordingFile(io.BytesIO):
+    def __init__(self, fs, location, mode):
+        super().__init__(fs.files.get(location, b'') if mode == 'rb' else b'')
+        self.fs, self.location, self.mode, self.size = fs, location, mode, len(self.getbuffer())
+
+    def close(self):
+        if self.mode == 'wb' and not self.closed:
+            self.fs._put(self.location, self.getvalue())
+        super().close()
+
+
+class RecordingFileSystem:
+    """Local in-memory file system which records the calls"""
+    def __init__(self):
+        self.files, self.generations, self.calls, self.lock = dict(), dict(), list(), threading.Lock()
+
+    def _record(self, *call):
+        with self.lock:
+            self.calls.append(call)
+
+    def open(self, location, mode='rb'):
+        self._record('open', location, mode)
+        return RecordingFile(self, location, mode)
+
+    def exists(self, location):
+        self._record('exists', location)
+        return location in self.files
+
+    def info(self, location):
+        self._record('info', location)
+        return {'name': location, 'size': len(self.files[location]), 'generation': self.generations[location]}
+
+    def _put(self, location, value):
+        self.files[location] = bytes(value)
+        self.generations[location] = self.generations.get(location, 0) + 1
+
+    def pipe_file(self, location, value):
+        self._record('pipe_file', location, len(value))
+        self._put(location, value)
+
+    def cat_file(self, location, start=None, end=None):
+        self._record('cat_file', location, start, end)
+        return self.files[location][start:end]
+
+    def cat(self, paths, on_error='raise', batch_size=None):
+        self._record('cat', len(paths), batch_size)
+        return {self._strip_protocol(path): self.files[path] if path in self.files else FileNotFoundError(path)
+                for path in paths}
+
+    def _strip_protocol(self, path):
+        return path[len('gs://'):] if path.startswith('gs://') else path
+
+    def merge(self, location, paths):
+        self._record('merge', location, len(paths))
+        self._put(location, b''.join([self.files[path] for path in paths]))
+
+    def rm(self, path):
+        self._record('rm', path)
+        for location in path if isinstance(path, list) else [path]:
+            self.files.pop(location)
+
+
+def clear_dir(directory):
+    for file_name in os.listdir(directory):
+        os.remove(os.path.join(directory, file_name))
+
+
 @pytest.fixture(scope='module')
 def storer():
     storer = GCSStorer()
@@ -31,3 +102,115 @@ def test_simple_flow(storer: GCSStorer):
 
     storer.write(data_copy1, dest_file)
     storer.remove(dest_file)
+
+
+def test_parallel_transfer():
+    fs = RecordingFileSystem()
+    storer = GCSStorer(fs=fs, part_size=10, max_workers=4)
+    storer.compose_limit = 4
+    data = os.urandom(255)
+    assert storer.write(data, 'gs://bucket/big.bin') == 'gs://bucket/big.bin'
+    assert storer.write(io.BytesIO(data), 'gs://bucket/big_io.bin') == 'gs://bucket/big_io.bin'
+    assert fs.files['gs://bucket/big.bin'] == data
+    assert fs.files['gs://bucket/big_io.bin'] == data
+    assert len([call for call in fs.calls if call[0] == 'pipe_file']) == 52
+    assert [call[2] for call in fs.calls if call[0] == 'merge' and call[1] == 'gs://bucket/big.bin'] == [2]
+    assert sorted(fs.files) == ['gs://bucket/big.bin', 'gs://bucket/big_io.bin']
+    assert storer.read('gs://bucket/big.bin') == data
+    assert len([call for call in fs.calls if call[0] == 'cat_file']) == 26
+    storer.write(data[:10], 'gs://bucket/small.bin')
+    assert storer.read('gs://bucket/small.bin') == data[:10]
+    assert len([call for call in fs.calls if call[0] == 'cat_file']) == 26
+    # Each write has its own part names
+    fs.calls.clear()
+    storer.write(data, 'gs://bucket/big.bin')
+    storer.write(data, 'gs://bucket/big.bin')
+    part_paths = [call[1] for call in fs.calls if call[0] == 'pipe_file']
+    assert len(set(part_paths)) == len(part_paths) == 52
+    assert sorted(fs.files) == ['gs://bucket/big.bin', 'gs://bucket/big_io.bin', 'gs://bucket/small.bin']
+
+def test_batch_operations():
+    fs = RecordingFileSystem()
+    storer = GCSStorer(fs=fs, max_workers=4)
+    locations = ['gs://bucket/file-{}.bin'.format(i) for i in range(10)]
+    data_dict = {location: location.encode() for location in locations[:5]}
+    data_dict[locations[5]] = io.BytesIO(locations[5].encode())
+    assert storer.write_many(data_dict) == locations[:6]
+    assert storer.exists_many(locations) == [True] * 6 + [False] * 4
+    assert storer.read_many(locations[4:8]) == [locations[4].encode(), locations[5].encode(), None, None]
+    assert storer.remove_many(locations[::2]) == [True, True, True, False, False]
+    assert sorted(fs.files) == sorted(locations[1:6:2])
+    assert len([call for call in fs.calls if call[0] == 'rm']) == 1
+
+def test_disk_cache(tmp_path):
+    fs = RecordingFileSystem()
+    storer = GCSStorer(fs=fs, cache_dir=str(tmp_path), cache_size=100)
+    storer.write(b'1' * 60, 'gs://bucket/a.bin')
+    storer.write(b'2' * 30, 'gs://bucket/b.bin')
+    assert storer.read('gs://bucket/a.bin') == b'1' * 60
+    assert storer.read('gs://bucket/a.bin') == b'1' * 60
+    for data_io in storer.get_io_stream('gs://bucket/b.bin'):
+        assert data_io.read() == b'2' * 30
+    assert storer.read('gs://bucket/b.bin') == b'2' * 30
+    assert storer.get_cache_stats() == {'hits': 2, 'misses': 2, 'files': 2, 'size': 90}
+    assert len([call for call in fs.calls if call[:2] == ('open', 'gs://bucket/a.bin')]) == 1
+    # A new generation is a new cache key, the least recently used file is evicted
+    storer.write(b'3' * 60, 'gs://bucket/a.bin')
+    assert storer.read('gs://bucket/a.bin') == b'3' * 60
+    assert storer.get_cache_stats() == {'hits': 2, 'misses': 3, 'files': 2, 'size': 90}
+    assert len(os.listdir(str(tmp_path))) == 2
+    with open(os.path.join(str(tmp_path), 'crashed.0123.tmp'), 'wb') as fp:
+        fp.write(b'4' * 10)
+    new_storer = GCSStorer(fs=fs, cache_dir=str(tmp_path), cache_size=100)
+    assert len(os.listdir(str(tmp_path))) == 2
+    assert new_storer.read('gs://bucket/b.bin') == b'2' * 30
+    assert new_storer.get_cache_stats()['hits'] == 1
+
+def test_zero_copy(tmp_path):
+    fs = RecordingFileSystem()
+    storer = GCSStorer(fs=fs, part_size=10, max_workers=4)
+    data = os.urandom(25)
+    storer.write(bytearray(data[:5]), 'gs://bucket/small.bin')
+    storer.write(memoryview(data), 'gs://bucket/big.bin')
+    data_io = io.BytesIO(data)
+    storer.write(data_io, 'gs://bucket/big_io.bin')
+    data_io.write(b'0')  # Buffer of the io object is released
+    assert not [call for call in fs.calls if call[0] == 'open']
+    buffer = bytearray(30)
+    assert storer.readinto('gs://bucket/big.bin', buffer) == 25
+    assert buffer[:25] == data
+    assert storer.read_view('gs://bucket/small.bin') == data[:5]
+    assert storer.read_view('gs://bucket/big.bin').readonly
+    with pytest.raises(ValueError):
+        storer.readinto('gs://bucket/big_io.bin', bytearray(10))
+    cached_storer = GCSStorer(fs=fs, part_size=10, cache_dir=str(tmp_path))
+    assert cached_storer.read_view('gs://bucket/big_io.bin') == data
+    assert cached_storer.read_view('gs://bucket/big_io.bin') == data
+    assert cached_storer.readinto('gs://bucket/big_io.bin', buffer) == 25
+    assert cached_storer.get_cache_stats()['hits'] == 2
+    # Cached files removed before being opened are read again from GCS
+    clear_dir(str(tmp_path))
+    assert cached_storer.read_view('gs://bucket/big_io.bin') == data
+    clear_dir(str(tmp_path))
+    assert cached_storer.readinto('gs://bucket/big_io.bin', buffer) == 25
+    assert buffer[:25] == data
+    clear_dir(str(tmp_path))
+    for data_io in cached_storer.get_io_stream('gs://bucket/big_io.bin'):
+        assert data_io.read() == data
+    assert cached_storer.get_cache_stats()['hits'] == 5
+
+def test_lazy_init(monkeypatch):
+    import google.auth
+    lazy_storer = GCSStorer(project_id='dummy')
+    assert lazy_storer._fs is None
+    assert lazy_storer.project_id == 'dummy'
+    # Default credentials are only resolved once, at the first access of project_id
+    auth_calls = list()
+    monkeypatch.setattr(google.auth, 'default', lambda: auth_calls.append(1) or (None, 'default-project'))
+    default_storer = GCSStorer()
+    assert not auth_calls and default_storer._fs is None
+    assert default_storer.project_id == 'default-project'
+    assert default_storer.project_id == 'default-project'
+    assert len(auth_calls) == 1
+    import_check = "import sys, xialib_gcp; assert 'gcsfs' not in sys.modules; assert 'google.cloud.bigquery' not in sys.modules"
+    assert subprocess.run([sys.executable, '-c', import_check]).returncode == 0
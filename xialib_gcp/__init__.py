@@ -1,23 +1,34 @@
-from xialib_gcp import adaptors
-from xialib_gcp import storers
-from xialib_gcp import archivers
-from xialib_gcp import publishers
-from xialib_gcp import subscribers
-from xialib_gcp import depositors
-
-from xialib_gcp.adaptors import BigQueryAdaptor
-from xialib_gcp.storers import GCSStorer
-from xialib_gcp.archivers import GCSListArchiver
-from xialib_gcp.publishers import PubsubPublisher
-from xialib_gcp.subscribers import PubsubSubscriber
-from xialib_gcp.depositors import FirestoreDepositor
-
-__all__ = \
-    adaptors.__all__ + \
-    storers.__all__ + \
-    archivers.__all__ + \
-    publishers.__all__ + \
-    subscribers.__all__ + \
-    depositors.__all__
-
-__version__ = "0.1.20"
\ No newline at end of file
+import importlib
+
+# Sub-packages and their classes are only imported at first access (PEP 562)
+_submodules = ['adaptors', 'storers', 'archivers', 'publishers', 'subscribers', 'depositors']
+
+_exports = {
+    'BigQueryAdaptor': 'adaptors',
+    'StorageWriteTransport': 'adaptors',
+    'BigQueryWriteTransport': 'adaptors',
+    'GCSStorer': 'storers',
+    'GCSListArchiver': 'archivers',
+    'PubsubPublisher': 'publishers',
+    'PubsubSubscriber': 'subscribers',
+    'FirestoreDepositor': 'depositors',
+    'AsyncFirestoreDepositor': 'depositors',
+}
+
+__all__ = list(_exports)
+
+__version__ = "0.1.20"
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    if name in _exports:
+        value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(list(globals()) + _submodules + __all__))
@@ -1,3 +1,4 @@
 from xialib_gcp.adaptors.bigquery_adaptor import BigQueryAdaptor
+from xialib_gcp.adaptors.storage_write_transport import StorageWriteTransport, BigQueryWriteTransport
 
-__all__ = ['BigQueryAdaptor']
\ No newline at end of file
+__all__ = ['BigQueryAdaptor', 'StorageWriteTransport', 'BigQueryWriteTransport']
\ No newline at end of file
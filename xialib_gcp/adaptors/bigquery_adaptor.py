@@ -1,14 +1,86 @@
+import io
 import os
+import uuid
+import datetime
 import json
+import random
 import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from google.api_core.exceptions import Conflict, BadRequest
+from google.api_core.exceptions import Conflict, BadRequest, NotFound, GoogleAPICallError
+from google.api_core.exceptions import Forbidden, TooManyRequests, ServiceUnavailable, InternalServerError
 from google.cloud import bigquery
 from xialib.adaptor import Adaptor
+from xialib_gcp.adaptors.storage_write_transport import StorageWriteTransport, BigQueryWriteTransport
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None  # pragma: no cover
+
+
+class _TokenBucket:
+    """Thread safe token bucket, tokens are refilled at a constant rate up to the capacity"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+
 
 class BigQueryAdaptor(Adaptor):
+    """Google BigQuery adaptor
+
+    Args:
+        connection: BigQuery client
+        project_id: project of the datasets
+        location: location of the datasets
+        load_format: file format of load jobs, json (newline delimited) or parquet (pyarrow is needed)
+        insert_engine: legacy (streaming insert / load job) or storage (Storage Write API, pyarrow is needed)
+        write_mode: stream type of Storage Write API. committed: each appended batch is visible at once,
+            offsets make the retry of a batch idempotent but a failed write leaves the batches appended before
+            the failure visible. pending: all batches become visible at commit, a failed write shows nothing
+        write_transport: transport of Storage Write API, default is the gRPC client
+        ctrl_cache: keep the control rows in memory, control table is only read at miss or refresh
+        ctrl_cache_file: sqlite file to persist the cached control rows (implies ctrl_cache)
+        upsert_engine: append (rows are inserted as they are) or merge (rows are staged then merged by key fields,
+            the last row of a key by _AGE, _SEQ, _NO is kept). With merge, a row with _OP = 'D' is kept as the
+            tombstone of its key, so an older replayed row can't bring the key back. Readers must filter
+            IFNULL(_OP, '') != 'D' and tombstones are removed by purge_deleted_rows
+        log_table_suffix: when set, raw data of a table is saved in a log table (table name + suffix) and
+            moved to the table by load_log_data. Without it, get_log_table_id always returns an empty string.
+            Log tables are filled by the insert engine. With the legacy engine, they are partitioned by ingestion
+            time and load_log_data only moves the rows which have left the streaming buffer (BigQuery rejects DML
+            on the others), the remaining rows are moved by the next call
+        partition_type: default partitioning of created tables, None, age (integer range of _AGE) or
+            ingestion (ingestion day). Could be overridden by the partition_type of table meta data.
+            Age ranges cover age_partition_count intervals of age_partition_interval (could be overridden
+            by the age_partition_interval of table meta data), later ages go to __UNPARTITIONED__
+        cluster_keys: cluster created tables by their key fields (at most 4 fields of supported types).
+            Could be overridden by the cluster_keys of table meta data
+        metadata_cache: keep known datasets and tables (listed once) with their schemas, so existing
+            datasets / tables are not created again and alter_column reads the table schema locally
 
+    Notes:
+        Age partitioning lets compaction only read the partitions of the age window.
+    """
     _age_field = {'field_name': '_AGE', 'key_flag': False, 'type_chain': ['int', 'ui_8'],
                   'format': None, 'encode': None, 'default': 0}
     _seq_field = {'field_name': '_SEQ', 'key_flag': False, 'type_chain': ['char', 'c_20'],
@@ -18,6 +90,32 @@ class BigQueryAdaptor(Adaptor):
     _op_field = {'field_name': '_OP', 'key_flag': False, 'type_chain': ['char', 'c_1'],
                  'format': None, 'encode': None, 'default': ''}
 
+    # Data is sent by a load job instead of streaming insert when one of the thresholds is reached
+    load_row_threshold = 50000
+    load_byte_threshold = 2 ** 26
+
+    # Streaming insert: rows per request, rows per second of a table, parallel requests and retries of a request
+    stream_slice_size = 10000
+    stream_row_rate = 100000
+    stream_max_workers = 4
+    stream_max_retries = 5
+    stream_retry_reasons = {'backendError', 'internalError', 'rateLimitExceeded', 'timeout', 'stopped'}
+
+    # Storage Write API: rows per Arrow record batch and retries of the failed batches
+    write_batch_rows = 10000
+    write_max_retries = 3
+
+    # Age range partitioning: _AGE values per partition and number of partitions (BigQuery limit: 10000)
+    age_partition_interval = 100
+    age_partition_count = 10000
+    cluster_types = {'INT64', 'STRING', 'BYTES'}
+
+    # Merge upsert: rows per staging load job and lifetime (seconds) of a staging table
+    merge_batch_rows = 100000
+    stage_table_expiration = 3600
+
+    _escape_table = str.maketrans({c: "_" for c in r"!@#$%^&*()[]{};:,./<>?\|`~-=+"})
+
     type_dict = {
         'NULL': ['null'],
         'INT64': ['int'],
@@ -26,6 +124,17 @@ class BigQueryAdaptor(Adaptor):
         'BYTES': ['blob']
     }
 
+    # Legacy SQL type names reported by table schemas
+    legacy_type_dict = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL'}
+
+    arrow_type_dict = {
+        'NULL': 'null',
+        'INT64': 'int64',
+        'FLOAT64': 'float64',
+        'STRING': 'string',
+        'BYTES': 'binary'
+    }
+
     # Ctrl Table definition
     _ctrl_table = [
         {'field_name': 'SOURCE_ID', 'key_flag': True, 'type_chain': ['char', 'c_255']},
@@ -37,13 +146,50 @@ class BigQueryAdaptor(Adaptor):
         {'field_name': 'FIELD_LIST', 'key_flag': False, 'type_chain': ['char', 'c_1000000']},
     ]
 
-    # variable: @table_name@, @source_id@
+    # variable: table name, query parameter: @source_ids
     select_from_ctrl_template = ("SELECT * FROM ( "
                                  "SELECT *, ROW_NUMBER() OVER (PARTITION BY SOURCE_ID ORDER BY VERSION DESC) RN "
-                                 "FROM `{}` WHERE SOURCE_ID = '{}' ) "
+                                 "FROM `{}` WHERE SOURCE_ID IN UNNEST(@source_ids) ) "
                                  "WHERE RN = 1")
 
-    def __init__(self, connection: bigquery.Client, project_id: str, location='EU', **kwargs):
+    # variable: target table, key columns, source table, source filter, join clause, newer condition,
+    # update / insert clauses. Deleted keys are kept as tombstones (_OP = 'D')
+    merge_template = ("MERGE `{}` T USING ( "
+                      "SELECT * EXCEPT(RN) FROM ( "
+                      "SELECT *, ROW_NUMBER() OVER (PARTITION BY {} ORDER BY _AGE DESC, _SEQ DESC, _NO DESC) RN "
+                      "FROM `{}` WHERE {} ) WHERE RN = 1 ) S "
+                      "ON {} "
+                      "WHEN MATCHED AND {} THEN UPDATE SET {} "
+                      "WHEN NOT MATCHED THEN INSERT ({}) VALUES ({})")
+
+    # variable: target table
+    purge_template = "DELETE FROM `{}` WHERE _OP = 'D' AND _AGE <= @end_age"
+
+    # Matched rows are only changed by a source row which is not older, so a replayed batch can't overwrite newer data
+    newer_condition = ("(IFNULL(S._AGE, 0) > IFNULL(T._AGE, 0) OR (IFNULL(S._AGE, 0) = IFNULL(T._AGE, 0) AND "
+                       "(IFNULL(S._SEQ, '') > IFNULL(T._SEQ, '') OR (IFNULL(S._SEQ, '') = IFNULL(T._SEQ, '') AND "
+                       "IFNULL(S._NO, 0) >= IFNULL(T._NO, 0)))))")
+
+    # variable: target table, columns, log table, age filter (tables without key fields)
+    append_template = ("INSERT INTO `{0}` ({1}) SELECT {1} FROM `{2}` "
+                       "WHERE {3} AND IFNULL(_OP, '') != 'D'")
+
+    # variable: statement to fill the target table, log table, age filter
+    compaction_template = ("BEGIN TRANSACTION; "
+                           "{0}; "
+                           "DELETE FROM `{1}` WHERE {2}; "
+                           "COMMIT TRANSACTION;")
+
+    # variable: log table
+    select_log_info_template = ("SELECT _AGE, MIN(_SEQ) START_SEQ, MAX(_SEQ) END_SEQ, COUNT(*) ROW_COUNT "
+                                "FROM `{}` GROUP BY _AGE ORDER BY _AGE")
+
+    def __init__(self, connection: bigquery.Client, project_id: str, location='EU', load_format: str = 'json',
+                 insert_engine: str = 'legacy', write_mode: str = 'committed',
+                 write_transport: StorageWriteTransport = None, ctrl_cache: bool = False,
+                 ctrl_cache_file: str = None, upsert_engine: str = 'append', log_table_suffix: str = None,
+                 partition_type: str = None, cluster_keys: bool = False, metadata_cache: bool = False,
+                 **kwargs):
         super().__init__(**kwargs)
         if not isinstance(connection, bigquery.Client):
             self.logger.error("connection must a big-query client", extra=self.log_context)
@@ -51,15 +197,51 @@ class BigQueryAdaptor(Adaptor):
         else:
             self.connection = connection
 
+        if load_format not in ['json', 'parquet'] or (load_format == 'parquet' and pyarrow is None):
+            self.logger.error("Load format {} not supported".format(load_format), extra=self.log_context)
+            raise ValueError("XIA-010008")
+        if insert_engine not in ['legacy', 'storage'] or write_mode not in ['committed', 'pending'] or \
+                (insert_engine == 'storage' and pyarrow is None):
+            self.logger.error("Insert engine {} / {} not supported".format(insert_engine, write_mode),
+                              extra=self.log_context)
+            raise ValueError("XIA-010009")
+        if upsert_engine not in ['append', 'merge']:
+            self.logger.error("Upsert engine {} not supported".format(upsert_engine), extra=self.log_context)
+            raise ValueError("XIA-010010")
+        if partition_type not in [None, 'age', 'ingestion']:
+            self.logger.error("Partition type {} not supported".format(partition_type), extra=self.log_context)
+            raise ValueError("XIA-010011")
         self.project_id = project_id
         self.location = location
+        self.load_format = load_format
+        self.insert_engine = insert_engine
+        self.write_mode = write_mode
+        self.write_transport = write_transport
+        self.upsert_engine = upsert_engine
+        self.log_table_suffix = log_table_suffix
+        self.partition_type = partition_type
+        self.cluster_keys = cluster_keys
+        self.metadata_cache = metadata_cache
+        self.known_datasets = None
+        self.metadata_lock = threading.Lock()
+        self.rate_limiters = dict()
+        self.column_plans = dict()
+        self.rate_limiter_lock = threading.Lock()
+        self.ctrl_cache = dict() if ctrl_cache or ctrl_cache_file else None
+        self.ctrl_cache_lock = threading.Lock()
+        self.ctrl_cache_db = None
+        if ctrl_cache_file:
+            self.ctrl_cache_db = sqlite3.connect(ctrl_cache_file, check_same_thread=False)
+            self.ctrl_cache_db.execute("CREATE TABLE IF NOT EXISTS CTRL_INFO "
+                                       "(SOURCE_ID TEXT PRIMARY KEY, VERSION INTEGER, CONTENT TEXT)")
+            self.ctrl_cache_db.commit()
 
     def _escape_column_name(self, old_name: str) -> str:
         """A column name must contain only letters (a-z, A-Z), numbers (0-9), or underscores (_),
         and it must start with a letter or underscore. The maximum column name length is 128 characters.
         A column name cannot use any of the following prefixes: _TABLE_, _FILE_, _PARTITION
         """
-        better_name = old_name.translate({ord(c): "_" for c in r"!@#$%^&*()[]{};:,./<>?\|`~-=+"})
+        better_name = old_name.translate(self._escape_table)
         if better_name[0].isdigit():
             better_name = '_' + better_name
         if better_name.upper().startswith('_TABLE_') or \
@@ -70,6 +252,37 @@ class BigQueryAdaptor(Adaptor):
             better_name = better_name[:128]
         return better_name
 
+    def _get_column_plan(self, table_id: str, field_data: List[dict]):
+        """Get source to BigQuery column name mapping of a table and if the mapping is an identity"""
+        plan_key = (table_id, tuple([field['field_name'] for field in field_data]))
+        column_plan = self.column_plans.get(plan_key, None)
+        if column_plan is None:
+            name_list = [field['field_name'] for field in field_data] + \
+                        [field['field_name'] for field in [self._age_field, self._seq_field,
+                                                           self._no_field, self._op_field]]
+            column_mapping = {name: self._escape_column_name(name) for name in name_list}
+            column_plan = (column_mapping, all([key == value for key, value in column_mapping.items()]))
+            self.column_plans[plan_key] = column_plan
+        return column_plan
+
+    def _rename_columns(self, table_id: str, field_data: List[dict], data: List[dict]) -> List[dict]:
+        column_mapping, identity = self._get_column_plan(table_id, field_data)
+        if identity:
+            column_set = column_mapping.keys()
+            if all([line.keys() <= column_set for line in data]):
+                return data
+        load_data = list()
+        for line in data:
+            new_line = dict()
+            for key, value in line.items():
+                new_key = column_mapping.get(key, None)
+                if new_key is None:
+                    new_key = self._escape_column_name(key)
+                    column_mapping[key] = new_key
+                new_line[new_key] = value
+            load_data.append(new_line)
+        return load_data
+
     def _get_field_type(self, type_chain: list):
         for type in reversed(type_chain):
             for key, value in self.type_dict.items():
@@ -99,16 +312,105 @@ class BigQueryAdaptor(Adaptor):
         bq_table_id = '.'.join([dataset_id, table_id.split('.')[-1]])
         return bq_table_id
 
-    def create_table(self, source_id: str, start_seq: str, meta_data: dict, field_data: List[dict],
-                     raw_flag: bool = False, table_id: str = None):
-        if table_id is None:
-            table_id = source_id
-        dataset = bigquery.Dataset(self._get_dataset_id(table_id))
+    def _get_known_tables(self, dataset_id: str):
+        """Known tables of a dataset with their schema (None when not read yet), None if the dataset is unknown"""
+        if not self.metadata_cache:
+            return None
+        with self.metadata_lock:
+            if self.known_datasets is None:
+                self.known_datasets = {'.'.join([item.project, item.dataset_id]): None
+                                       for item in self.connection.list_datasets(project=self.project_id)}
+            if dataset_id not in self.known_datasets:
+                return None
+            if self.known_datasets[dataset_id] is None:
+                self.known_datasets[dataset_id] = {'.'.join([item.project, item.dataset_id, item.table_id]): None
+                                                   for item in self.connection.list_tables(dataset_id)}
+            return self.known_datasets[dataset_id]
+
+    def _set_known_table(self, bq_table_id: str, schema=None):
+        if not self.metadata_cache or self.known_datasets is None:
+            return
+        with self.metadata_lock:
+            known_tables = self.known_datasets.get(bq_table_id.rsplit('.', 1)[0], None)
+            if known_tables is not None:
+                known_tables[bq_table_id] = schema
+
+    def _pop_known_table(self, bq_table_id: str):
+        if not self.metadata_cache or self.known_datasets is None:
+            return
+        with self.metadata_lock:
+            known_tables = self.known_datasets.get(bq_table_id.rsplit('.', 1)[0], None)
+            if known_tables is not None:
+                known_tables.pop(bq_table_id, None)
+
+    def clear_metadata_cache(self):
+        with self.metadata_lock:
+            self.known_datasets = None
+
+    def _create_dataset(self, dataset_id: str):
+        if self._get_known_tables(dataset_id) is not None:
+            return
+        dataset = bigquery.Dataset(dataset_id)
         dataset.location = self.location
+        known_tables = dict()
         try:
             dataset = self.connection.create_dataset(dataset, timeout=30)
         except Conflict as e:
             self.logger.info("Dataset already exists, donothing", extra=self.log_context)
+            known_tables = None
+        if self.metadata_cache and self.known_datasets is not None:
+            with self.metadata_lock:
+                self.known_datasets[dataset_id] = known_tables
+
+    def _create_bq_table(self, table: bigquery.Table):
+        bq_table_id = '.'.join([table.project, table.dataset_id, table.table_id])
+        known_tables = self._get_known_tables('.'.join([table.project, table.dataset_id]))
+        if known_tables is not None and bq_table_id in known_tables:
+            return table
+        table = self.connection.create_table(table, True, timeout=30)
+        self._set_known_table(bq_table_id, table.schema if table else None)
+        return table
+
+    def _delete_bq_table(self, bq_table_id: str):
+        # Always sent: the table could be created by another worker after the listing. Only creates are skipped
+        self.connection.delete_table(bq_table_id, not_found_ok=True, timeout=30)
+        self._pop_known_table(bq_table_id)
+
+    def _get_column_types(self, table_id: str) -> dict:
+        bq_table_id = self._get_table_id(table_id)
+        known_tables = self._get_known_tables(bq_table_id.rsplit('.', 1)[0])
+        schema = known_tables.get(bq_table_id, None) if known_tables else None
+        if schema is None:
+            schema = self.connection.get_table(bq_table_id).schema
+            self._set_known_table(bq_table_id, schema)
+        return {schema_field.name: self.legacy_type_dict.get(schema_field.field_type, schema_field.field_type)
+                for schema_field in schema}
+
+    def _set_table_layout(self, table: bigquery.Table, field_list: List[dict], meta_data: dict):
+        """Partitioning and clustering of a table to be created"""
+        meta_data = meta_data if meta_data else dict()
+        partition_type = meta_data.get('partition_type', self.partition_type)
+        if partition_type == 'age' and '_AGE' in [field['field_name'] for field in field_list]:
+            interval = meta_data.get('age_partition_interval', self.age_partition_interval)
+            table.range_partitioning = bigquery.RangePartitioning(
+                field='_AGE',
+                range_=bigquery.PartitionRange(start=0, end=interval * self.age_partition_count, interval=interval)
+            )
+        elif partition_type == 'ingestion':
+            table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY)
+        if meta_data.get('cluster_keys', self.cluster_keys):
+            cluster_fields = [self._escape_column_name(field['field_name']) for field in field_list
+                              if field.get('key_flag', False)
+                              and self._get_field_type(field['type_chain']) in self.cluster_types]
+            if cluster_fields:
+                table.clustering_fields = cluster_fields[:4]
+        return table
+
+    def create_table(self, source_id: str, start_seq: str, meta_data: dict, field_data: List[dict],
+                     raw_flag: bool = False, table_id: str = None):
+        if table_id is None:
+            table_id = source_id
+        self._create_dataset(self._get_dataset_id(table_id))
 
         field_list = field_data.copy()
         if table_id != self._ctrl_table_id:
@@ -118,11 +420,22 @@ class BigQueryAdaptor(Adaptor):
             field_list.append(self._op_field)
         schema = self._get_table_schema(field_list)
         table = bigquery.Table(self._get_table_id(table_id), schema=schema)
-        table = self.connection.create_table(table, True, timeout=30)
+        table = self._set_table_layout(table, field_list, meta_data)
+        table = self._create_bq_table(table)
         if table_id == self._ctrl_table_id:
             return True if table else False
 
-        return self.set_ctrl_info(source_id, table_id=table_id, log_table_id=table_id,
+        log_table_id = table_id
+        if self.log_table_suffix and not raw_flag:
+            log_table_id = table_id + self.log_table_suffix
+            log_table = bigquery.Table(self._get_table_id(log_table_id), schema=schema)
+            log_meta_data = meta_data
+            if self.insert_engine == 'legacy':
+                # Streamed rows only get a partition when they leave the streaming buffer
+                log_meta_data = dict(meta_data if meta_data else dict(), partition_type='ingestion')
+            log_table = self._set_table_layout(log_table, field_list, log_meta_data)
+            self._create_bq_table(log_table)
+        return self.set_ctrl_info(source_id, table_id=table_id, log_table_id=log_table_id,
                                   meta_data=meta_data, field_list=field_data,
                                   start_seq=start_seq)
 
@@ -130,7 +443,10 @@ class BigQueryAdaptor(Adaptor):
     def drop_table(self, source_id: str):
         table_id = source_id
         try:
-            self.connection.delete_table(self._get_table_id(table_id), not_found_ok=True, timeout=30)
+            self._delete_bq_table(self._get_table_id(table_id))
+            ctrl_info = self.get_ctrl_info(source_id)
+            if ctrl_info.get('LOG_TABLE_ID', None) not in [None, ctrl_info.get('TABLE_ID', None)]:
+                self._delete_bq_table(self._get_table_id(ctrl_info['LOG_TABLE_ID']))
             self.set_ctrl_info(source_id, table_id=None)
         except Exception as e:  # pragma: no cover
             return False  # pragma: no cover
@@ -144,32 +460,93 @@ class BigQueryAdaptor(Adaptor):
                                          self._get_table_id(new_table_id),
                                          timeout=60)
         job.result()
+        self._set_known_table(self._get_table_id(new_table_id))
 
         table_param['table_id'] = new_table_id
-        table_param['log_table_id'] = new_table_id
+        if table_param.get('log_table_id', None) in [None, old_table_id]:
+            table_param['log_table_id'] = new_table_id
         return self.set_ctrl_info(source_id, **table_param)
 
-    def get_ctrl_info(self, source_id):
-        query = self.select_from_ctrl_template.format(self._get_table_id(BigQueryAdaptor._ctrl_table_id),
-                                                      source_id.replace(';', ''))
-        query_job = self.connection.query(query)
-        return_line = {'SOURCE_ID': source_id}
+    def _get_cached_ctrl_info(self, source_id: str):
+        if self.ctrl_cache is None:
+            return None
+        with self.ctrl_cache_lock:
+            ctrl_line = self.ctrl_cache.get(source_id, None)
+            if ctrl_line is None and self.ctrl_cache_db is not None:
+                row = self.ctrl_cache_db.execute("SELECT CONTENT FROM CTRL_INFO WHERE SOURCE_ID = ?",
+                                                 (source_id, )).fetchone()
+                if row is not None:
+                    ctrl_line = json.loads(row[0])
+                    self.ctrl_cache[source_id] = ctrl_line
+        return ctrl_line
+
+    def _set_cached_ctrl_info(self, source_id: str, ctrl_line: dict):
+        """Control rows are cached as saved in the control table (meta data and field list as string)"""
+        if self.ctrl_cache is None:
+            return
+        with self.ctrl_cache_lock:
+            self.ctrl_cache[source_id] = ctrl_line
+            if self.ctrl_cache_db is not None:
+                self.ctrl_cache_db.execute("INSERT OR REPLACE INTO CTRL_INFO VALUES (?, ?, ?)",
+                                           (source_id, ctrl_line.get('VERSION', None), json.dumps(ctrl_line)))
+                self.ctrl_cache_db.commit()
+
+    def clear_ctrl_cache(self):
+        if self.ctrl_cache is None:
+            return
+        with self.ctrl_cache_lock:
+            self.ctrl_cache.clear()
+            if self.ctrl_cache_db is not None:
+                self.ctrl_cache_db.execute("DELETE FROM CTRL_INFO")
+                self.ctrl_cache_db.commit()
+
+    def _query_ctrl_info(self, source_ids: List[str]) -> dict:
+        query = self.select_from_ctrl_template.format(self._get_table_id(BigQueryAdaptor._ctrl_table_id))
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter('source_ids', 'STRING', list(source_ids))]
+        )
+        query_job = self.connection.query(query, job_config=job_config)
+        ctrl_lines = {source_id: {'SOURCE_ID': source_id} for source_id in source_ids}
         for row in query_job:
             return_line = dict(row)
-            break
-        return_line.pop('RN', None)
-        if return_line['SOURCE_ID'] != source_id:  # pragma: no cover
-            self.logger.error("Ctrl Table: {} != {}".format(return_line['SOURCE_ID'],
-                                                            source_id), extra=self.log_context)  # pragma: no cover
-            raise ValueError("XIA-000021")  # pragma: no cover
+            return_line.pop('RN', None)
+            if return_line['SOURCE_ID'] not in ctrl_lines:  # pragma: no cover
+                self.logger.error("Ctrl Table: {} not in {}".format(return_line['SOURCE_ID'], source_ids),
+                                  extra=self.log_context)  # pragma: no cover
+                raise ValueError("XIA-000021")  # pragma: no cover
+            ctrl_lines[return_line['SOURCE_ID']] = return_line
+        return ctrl_lines
+
+    def _decode_ctrl_info(self, ctrl_line: dict) -> dict:
+        return_line = ctrl_line.copy()
         if return_line.get('META_DATA', None) is not None:
             return_line['META_DATA'] = self._string_to_meta_data(return_line.get('META_DATA'))
         if return_line.get('FIELD_LIST', None) is not None:
             return_line['FIELD_LIST'] = self._string_to_field_data(return_line['FIELD_LIST'])
         return return_line
 
-    def set_ctrl_info(self, source_id: str, **kwargs):
-        old_ctrl_info = self.get_ctrl_info(source_id)
+    def get_ctrl_info_many(self, source_ids: List[str], refresh: bool = False) -> dict:
+        """Get control information of several sources by a single query
+
+        Returns:
+            decoded control line of each source id
+        """
+        ctrl_lines = dict()
+        for source_id in source_ids:
+            ctrl_line = None if refresh else self._get_cached_ctrl_info(source_id)
+            if ctrl_line is not None:
+                ctrl_lines[source_id] = ctrl_line
+        missing_ids = [source_id for source_id in dict.fromkeys(source_ids) if source_id not in ctrl_lines]
+        if missing_ids:
+            for source_id, ctrl_line in self._query_ctrl_info(missing_ids).items():
+                self._set_cached_ctrl_info(source_id, ctrl_line)
+                ctrl_lines[source_id] = ctrl_line
+        return {source_id: self._decode_ctrl_info(ctrl_lines[source_id]) for source_id in source_ids}
+
+    def get_ctrl_info(self, source_id, refresh: bool = False):
+        return self.get_ctrl_info_many([source_id], refresh)[source_id]
+
+    def _get_new_ctrl_info(self, old_ctrl_info: dict, **kwargs) -> dict:
         new_ctrl_info = old_ctrl_info.copy()
         if new_ctrl_info.get('VERSION', None) is None:
             new_ctrl_info['VERSION'] = 1  # pragma: no cover
@@ -187,34 +564,301 @@ class BigQueryAdaptor(Adaptor):
                 new_ctrl_info[key] = self._field_data_to_string(kwargs[key.lower()])
             elif key != 'SOURCE_ID':
                 new_ctrl_info[key] = kwargs[key.lower()]
-        return self.upsert_data(self._ctrl_table_id, self._ctrl_table, [new_ctrl_info], True)
+        return new_ctrl_info
 
-    def insert_raw_data(self, log_table_id: str, field_data: List[dict], data: List[dict], **kwargs):
-        table_id = log_table_id
-        for i in range(((len(data) - 1) // 10000) + 1):
-            start, end = i * 10000, (i + 1) * 10000
-            load_data = [{self._escape_column_name(k): v for k, v in line.items()} for line in data[start: end]]
+    def set_ctrl_info_many(self, ctrl_params: dict) -> bool:
+        """Save new versions of control information of several sources by a single insert
+
+        Args:
+            ctrl_params: source id as key, dictionary of set_ctrl_info keyword arguments as value
+        """
+        old_ctrl_infos = self.get_ctrl_info_many(list(ctrl_params))
+        new_ctrl_infos = {source_id: self._get_new_ctrl_info(old_ctrl_infos[source_id], **kwargs)
+                          for source_id, kwargs in ctrl_params.items()}
+        if not new_ctrl_infos:
+            return True
+        if self.upsert_data(self._ctrl_table_id, self._ctrl_table, list(new_ctrl_infos.values()), True):
+            for source_id, new_ctrl_info in new_ctrl_infos.items():
+                self._set_cached_ctrl_info(source_id, new_ctrl_info)
+            return True
+        return False
+
+    def set_ctrl_info(self, source_id: str, **kwargs):
+        return self.set_ctrl_info_many({source_id: kwargs})
+
+    def _get_arrow_schema(self, table_id: str, field_data: List[dict]):
+        field_list = field_data.copy()
+        if table_id != self._ctrl_table_id:
+            field_list.extend([self._age_field, self._seq_field, self._no_field, self._op_field])
+        return pyarrow.schema([(self._escape_column_name(field['field_name']),
+                                getattr(pyarrow, self.arrow_type_dict[self._get_field_type(field['type_chain'])])())
+                               for field in field_list])
+
+    def _get_load_file(self, table_id: str, field_data: List[dict], load_data: List[dict]):
+        if self.load_format == 'parquet':
+            if field_data:
+                arrow_schema = self._get_arrow_schema(table_id, field_data)
+                arrow_table = pyarrow.Table.from_pylist(load_data, schema=arrow_schema)
+            else:
+                arrow_table = pyarrow.Table.from_pylist(load_data)
+            file_obj = io.BytesIO()
+            pyarrow.parquet.write_table(arrow_table, file_obj)
+            file_obj.seek(0)
+            return file_obj, bigquery.SourceFormat.PARQUET
+        file_obj = io.BytesIO('\n'.join([json.dumps(line, ensure_ascii=False) for line in load_data]).encode())
+        return file_obj, bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+
+    def _load_raw_data(self, table_id: str, field_data: List[dict], load_data: List[dict]) -> bool:
+        """Append data by one load job, the file is prepared in memory"""
+        file_obj, source_format = self._get_load_file(table_id, field_data, load_data)
+        job_config = bigquery.LoadJobConfig(source_format=source_format,
+                                            write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        try:
+            job = self.connection.load_table_from_file(file_obj, self._get_table_id(table_id),
+                                                       location=self.location, job_config=job_config)
+            job.result()
+        except GoogleAPICallError as e:
+            self.logger.error("Load {} Error: {}".format(table_id, e), extra=self.log_context)
+            return False
+        return True
+
+    def _is_bulk_data(self, data: List[dict]) -> bool:
+        if len(data) >= self.load_row_threshold:
+            return True
+        sample = data[:100]
+        sample_size = sum([len(json.dumps(line, ensure_ascii=False)) for line in sample])
+        return sample_size * len(data) / max(len(sample), 1) >= self.load_byte_threshold
+
+    def _get_rate_limiter(self, table_id: str) -> _TokenBucket:
+        with self.rate_limiter_lock:
+            if table_id not in self.rate_limiters:
+                self.rate_limiters[table_id] = _TokenBucket(self.stream_row_rate, self.stream_row_rate)
+            return self.rate_limiters[table_id]
+
+    def _get_backoff_time(self, retry: int) -> float:
+        return min(2 ** retry, 32) * (0.5 + random.random() / 2)
+
+    def _get_row_ids(self, data: List[dict]) -> List[str]:
+        """Insert ids of streaming insert: (_AGE, _SEQ, _NO) of the row, or a random prefix with the row index"""
+        prefix = uuid.uuid4().hex
+        return ['{}-{}-{}'.format(line.get('_AGE', None), line['_SEQ'], line['_NO'])
+                if line.get('_SEQ', None) is not None and line.get('_NO', None) is not None
+                else '{}-{}'.format(prefix, i) for i, line in enumerate(data)]
+
+    def _stream_raw_data(self, table_id: str, data: List[dict]) -> bool:
+        """Streaming insert of one slice. Quota errors are retried with exponential backoff and
+        only the rows with retryable errors are sent again. Rows keep their insert ids between the retries,
+        so BigQuery could drop the rows already inserted by a failed request
+        """
+        rate_limiter = self._get_rate_limiter(table_id)
+        load_data, load_ids = data, self._get_row_ids(data)
+        for retry in range(self.stream_max_retries + 1):
+            rate_limiter.acquire(len(load_data))
             try:
-                errors = self.connection.insert_rows_json(self._get_table_id(table_id), load_data)
+                errors = self.connection.insert_rows_json(self._get_table_id(table_id), load_data, row_ids=load_ids)
+            except (TooManyRequests, ServiceUnavailable, InternalServerError, Forbidden) as e:
+                if isinstance(e, Forbidden) and 'quota' not in format(e).lower():
+                    self.logger.error("Insert {} Error: {}".format(table_id, e), extra=self.log_context)
+                    return False
+                self.logger.warning("Insert {} retry {}: {}".format(table_id, retry, e), extra=self.log_context)
+                time.sleep(self._get_backoff_time(retry))
+                continue
             except BadRequest as e:  # pragma: no cover
+                self.logger.error("Insert {} Error: {}".format(table_id, e), extra=self.log_context)
                 return False  # pragma: no cover
-            if len(data) > 10000:  # bigquery quota
-                time.sleep(1)  # pragma: no cover
             if errors == []:
-                continue
-            else:  # pragma: no cover
+                return True
+            reasons = {error.get('reason', None) for line in errors for error in line.get('errors', [])}
+            if not reasons <= self.stream_retry_reasons:
                 self.logger.error("Insert {} Error: {}".format(table_id, errors), extra=self.log_context)
                 return False
+            load_data = [load_data[line['index']] for line in errors]
+            load_ids = [load_ids[line['index']] for line in errors]
+            time.sleep(self._get_backoff_time(retry))
+        self.logger.error("Insert {} Error: too many retries".format(table_id), extra=self.log_context)
+        return False
+
+    def _get_table_path(self, table_id: str) -> str:
+        project_id, dataset_id, table_name = self._get_table_id(table_id).split('.')
+        return 'projects/{}/datasets/{}/tables/{}'.format(project_id, dataset_id, table_name)
+
+    def _write_raw_data(self, table_id: str, field_data: List[dict], data: List[dict]) -> bool:
+        """Append data by Storage Write API with Arrow record batches
+
+        All batches are sent through one request stream. Failed batches are sent again at their offsets of the
+        same write stream, so the batches already appended are not duplicated
+        """
+        if self.write_transport is None:
+            self.write_transport = BigQueryWriteTransport()
+        if field_data:
+            arrow_table = pyarrow.Table.from_pylist(data, schema=self._get_arrow_schema(table_id, field_data))
+        else:
+            arrow_table = pyarrow.Table.from_pylist(data)
+        arrow_schema = arrow_table.schema.serialize().to_pybytes()
+        table_path = self._get_table_path(table_id)
+        batch_list, offset = list(), 0
+        for arrow_batch in arrow_table.to_batches(max_chunksize=self.write_batch_rows):
+            batch_list.append((offset, arrow_batch.serialize().to_pybytes()))
+            offset += arrow_batch.num_rows
+        try:
+            stream_name = self.write_transport.create_stream(table_path, self.write_mode)
+            for retry in range(self.write_max_retries + 1):
+                try:
+                    failed = self.write_transport.append_rows(stream_name, arrow_schema,
+                                                              [batch for _, batch in batch_list],
+                                                              [offset for offset, _ in batch_list])
+                except GoogleAPICallError as e:
+                    failed = {batch_list[0][0]: [str(e)]}
+                if not failed:
+                    break
+                # Batches after a failed one are rejected by offset check, so they are all sent again
+                batch_list = [(offset, batch) for offset, batch in batch_list if offset >= min(failed)]
+                if retry < self.write_max_retries:
+                    self.logger.warning("Write {} retry {}: {}".format(table_id, retry, failed),
+                                        extra=self.log_context)
+                    time.sleep(self._get_backoff_time(retry))
+            if failed:
+                self.logger.error("Write {} Error: {}".format(table_id, failed), extra=self.log_context)
+                return False
+            self.write_transport.finalize_stream(stream_name)
+            if self.write_mode == 'pending':
+                errors = self.write_transport.commit_streams(table_path, [stream_name])
+                if errors:
+                    self.logger.error("Commit {} Error: {}".format(table_id, errors), extra=self.log_context)
+                    return False
+        except GoogleAPICallError as e:
+            self.logger.error("Write {} Error: {}".format(table_id, e), extra=self.log_context)
+            return False
+        return True
+
+    def insert_raw_data(self, log_table_id: str, field_data: List[dict], data: List[dict], **kwargs):
+        table_id = log_table_id
+        data = self._rename_columns(table_id, field_data, data)
+        if data and self.insert_engine == 'storage':
+            return self._write_raw_data(table_id, field_data, data)
+        if data and self._is_bulk_data(data):
+            return self._load_raw_data(table_id, field_data, data)
+        slice_list = [data[i: i + self.stream_slice_size] for i in range(0, len(data), self.stream_slice_size)]
+        if len(slice_list) <= 1:
+            return all([self._stream_raw_data(table_id, data_slice) for data_slice in slice_list])
+        with ThreadPoolExecutor(max_workers=self.stream_max_workers) as executor:
+            results = list(executor.map(lambda data_slice: self._stream_raw_data(table_id, data_slice), slice_list))
+        return all(results)
+
+    def _get_merge_query(self, table_id: str, stage_table_id: str, field_data: List[dict],
+                         where_clause: str = 'TRUE') -> str:
+        column_mapping, _ = self._get_column_plan(table_id, field_data)
+        column_list = ['`{}`'.format(column_mapping[field['field_name']]) for field in
+                       field_data + [self._age_field, self._seq_field, self._no_field, self._op_field]]
+        key_list = ['`{}`'.format(column_mapping[field['field_name']]) for field in field_data
+                    if field.get('key_flag', False)]
+        if not key_list:
+            return self.append_template.format(self._get_table_id(table_id), ', '.join(column_list),
+                                               self._get_table_id(stage_table_id), where_clause)
+        return self.merge_template.format(
+            self._get_table_id(table_id),
+            ', '.join(key_list),
+            self._get_table_id(stage_table_id),
+            where_clause,
+            ' AND '.join(['T.{0} = S.{0}'.format(key) for key in key_list]),
+            self.newer_condition,
+            ', '.join(['{0} = S.{0}'.format(column) for column in column_list]),
+            ', '.join(column_list),
+            ', '.join(['S.{}'.format(column) for column in column_list])
+        )
+
+    def _merge_data(self, table_id: str, field_data: List[dict], data: List[dict]) -> bool:
+        """Load data into a staging table by batches and apply it to the target table by one MERGE"""
+        if not any([field.get('key_flag', False) for field in field_data]):
+            self.logger.warning("{} has no key field, data is appended".format(table_id), extra=self.log_context)
+            return self.insert_raw_data(table_id, field_data, data)
+        data = self._rename_columns(table_id, field_data, data)
+        stage_table_id = '{}_stage_{}'.format(table_id, uuid.uuid4().hex)
+        field_list = field_data + [self._age_field, self._seq_field, self._no_field, self._op_field]
+        stage_table = bigquery.Table(self._get_table_id(stage_table_id), schema=self._get_table_schema(field_list))
+        stage_table.expires = datetime.datetime.now(datetime.timezone.utc) + \
+                              datetime.timedelta(seconds=self.stage_table_expiration)
+        try:
+            self.connection.create_table(stage_table, timeout=30)
+            for i in range(0, len(data), self.merge_batch_rows):
+                if not self._load_raw_data(stage_table_id, field_data, data[i: i + self.merge_batch_rows]):
+                    return False
+            query_job = self.connection.query(self._get_merge_query(table_id, stage_table_id, field_data),
+                                              location=self.location)
+            query_job.result()
+        except GoogleAPICallError as e:
+            self.logger.error("Merge {} Error: {}".format(table_id, e), extra=self.log_context)
+            return False
+        finally:
+            self.connection.delete_table(self._get_table_id(stage_table_id), not_found_ok=True, timeout=30)
         return True
 
+    def _get_log_table_pair(self, source_id: str, ctrl_info: dict = None):
+        """Table id and log table id of a source, log table id is None when the source has no distinct log table.
+        Only adaptors with a log table suffix use log tables, the others don't read the control table here.
+        """
+        if not self.log_table_suffix:
+            return None, None
+        if ctrl_info is None:
+            ctrl_info = self.get_ctrl_info(source_id)
+        table_id, log_table_id = ctrl_info.get('TABLE_ID', None), ctrl_info.get('LOG_TABLE_ID', None)
+        if not table_id or not log_table_id or table_id == log_table_id:
+            return table_id, None
+        return table_id, log_table_id
+
     def get_log_table_id(self, source_id: str):
-        return ''
+        return self._get_log_table_pair(source_id)[1] or ''
 
     def load_log_data(self, source_id: str, start_age: int = None, end_age: int = None):
+        """Move the rows of the age window [start_age, end_age] from the log table to the table
+
+        The window is merged by key fields and removed from the log table in one transaction. Only the window
+        of the log table is read (pruned by age partitioning), but the MERGE joins the whole target table,
+        clustering the target table by key fields reduces the bytes it scans. Open bounds mean the whole log table.
+        Rows of an ingestion time partitioned log table which are still in the streaming buffer are left in it.
+        """
+        if not self.log_table_suffix:
+            return True
+        ctrl_info = self.get_ctrl_info(source_id)
+        table_id, log_table_id = self._get_log_table_pair(source_id, ctrl_info)
+        if log_table_id is None:
+            return True
+        age_conditions, query_parameters = list(), list()
+        try:
+            time_partitioning = self.connection.get_table(self._get_table_id(log_table_id)).time_partitioning
+        except GoogleAPICallError as e:
+            self.logger.error("Compaction {} Error: {}".format(table_id, e), extra=self.log_context)
+            return False
+        if time_partitioning is not None and time_partitioning.field is None:
+            # Rows in the streaming buffer have no partition time yet
+            age_conditions.append('_PARTITIONTIME IS NOT NULL')
+        if start_age is not None:
+            age_conditions.append('_AGE >= @start_age')
+            query_parameters.append(bigquery.ScalarQueryParameter('start_age', 'INT64', start_age))
+        if end_age is not None:
+            age_conditions.append('_AGE <= @end_age')
+            query_parameters.append(bigquery.ScalarQueryParameter('end_age', 'INT64', end_age))
+        where_clause = ' AND '.join(age_conditions) if age_conditions else 'TRUE'
+        field_data = ctrl_info.get('FIELD_LIST', None) or []
+        fill_query = self._get_merge_query(table_id, log_table_id, field_data, where_clause)
+        query = self.compaction_template.format(fill_query, self._get_table_id(log_table_id), where_clause)
+        try:
+            query_job = self.connection.query(query, location=self.location,
+                                              job_config=bigquery.QueryJobConfig(query_parameters=query_parameters))
+            query_job.result()
+        except GoogleAPICallError as e:
+            self.logger.error("Compaction {} Error: {}".format(table_id, e), extra=self.log_context)
+            return False
         return True
 
     def get_log_info(self, source_id: str):
-        return []
+        """Sequence range and row count of each age of the log table"""
+        table_id, log_table_id = self._get_log_table_pair(source_id)
+        if log_table_id is None:
+            return []
+        query_job = self.connection.query(self.select_log_info_template.format(self._get_table_id(log_table_id)),
+                                          location=self.location)
+        return [{key.lower(): value for key, value in dict(row).items()} for row in query_job]
 
     def upsert_data(self,
                     table_id: str,
@@ -222,9 +866,33 @@ class BigQueryAdaptor(Adaptor):
                     data: List[dict],
                     replay_safe: bool = False,
                     **kwargs):
+        if self.upsert_engine == 'merge' and table_id != self._ctrl_table_id and data:
+            return self._merge_data(table_id, field_data, data)
         return self.insert_raw_data(table_id, field_data, data)
 
+    def purge_deleted_rows(self, table_id: str, end_age: int) -> bool:
+        """Remove the tombstones of deleted keys up to end_age
+
+        A row older than a removed tombstone could bring its key back, so end_age must be older than any replay
+        """
+        query_parameters = [bigquery.ScalarQueryParameter('end_age', 'INT64', end_age)]
+        try:
+            query_job = self.connection.query(self.purge_template.format(self._get_table_id(table_id)),
+                                              location=self.location,
+                                              job_config=bigquery.QueryJobConfig(query_parameters=query_parameters))
+            query_job.result()
+        except GoogleAPICallError as e:
+            self.logger.error("Purge {} Error: {}".format(table_id, e), extra=self.log_context)
+            return False
+        return True
+
     def alter_column(self, table_id: str, old_field_line: dict, new_field_line: dict):
         old_type = self._get_field_type(old_field_line['type_chain'])
+        if self.metadata_cache and 'field_name' in old_field_line:
+            try:
+                column_types = self._get_column_types(table_id)
+                old_type = column_types.get(self._escape_column_name(old_field_line['field_name']), old_type)
+            except NotFound as e:
+                self.logger.warning("Table {} not found".format(table_id), extra=self.log_context)
         new_type = self._get_field_type(new_field_line['type_chain'])
         return True if old_type == new_type else False
@@ -0,0 +1,97 @@
+import abc
+from typing import List, Dict
+
+
+class StorageWriteTransport(metaclass=abc.ABCMeta):
+    """Transport of BigQuery Storage Write API requests
+
+    Streams are identified by their name. Data is sent as serialized Arrow schema / record batch.
+    Another transport (for example a local stub) could be given to the adaptor to replace the gRPC one.
+    """
+    @abc.abstractmethod
+    def create_stream(self, table_path: str, mode: str) -> str:
+        """Create a write stream
+
+        Args:
+            table_path: projects/{project}/datasets/{dataset}/tables/{table}
+            mode: committed (data visible after each append) or pending (data visible after commit)
+
+        Returns:
+            name of the stream
+        """
+
+    @abc.abstractmethod
+    def append_rows(self, stream_name: str, arrow_schema: bytes, arrow_batches: List[bytes],
+                    offsets: List[int]) -> Dict[int, List[str]]:
+        """Append Arrow record batches at the given offsets of the stream by one request stream
+
+        Returns:
+            error messages by offset of the failed batches, empty dict when all the batches are appended
+            (a batch already appended at its offset counts as appended)
+        """
+
+    @abc.abstractmethod
+    def finalize_stream(self, stream_name: str):
+        """No more rows could be appended to the stream"""
+
+    @abc.abstractmethod
+    def commit_streams(self, table_path: str, stream_names: List[str]) -> List[str]:
+        """Commit the finalized pending streams atomically
+
+        Returns:
+            error messages, empty list when the streams are committed
+        """
+
+
+class BigQueryWriteTransport(StorageWriteTransport):
+    """gRPC transport based on BigQuery Storage client (google-cloud-bigquery-storage)"""
+    ALREADY_EXISTS = 6
+
+    def __init__(self, write_client=None):
+        from google.cloud import bigquery_storage_v1
+        self.types = bigquery_storage_v1.types
+        self.client = write_client if write_client is not None else bigquery_storage_v1.BigQueryWriteClient()
+
+    def create_stream(self, table_path: str, mode: str) -> str:
+        if mode == 'pending':
+            stream_type = self.types.WriteStream.Type.PENDING
+        else:
+            stream_type = self.types.WriteStream.Type.COMMITTED
+        write_stream = self.types.WriteStream(type_=stream_type)
+        return self.client.create_write_stream(parent=table_path, write_stream=write_stream).name
+
+    def _get_requests(self, stream_name: str, arrow_schema: bytes, arrow_batches: List[bytes], offsets: List[int]):
+        for i, (arrow_batch, offset) in enumerate(zip(arrow_batches, offsets)):
+            # Stream name and writer schema are only needed by the first request of the connection
+            arrow_data = self.types.AppendRowsRequest.ArrowData(
+                rows=self.types.ArrowRecordBatch(serialized_record_batch=arrow_batch)
+            )
+            if i == 0:
+                arrow_data.writer_schema = self.types.ArrowSchema(serialized_schema=arrow_schema)
+                yield self.types.AppendRowsRequest(write_stream=stream_name, offset=offset, arrow_rows=arrow_data)
+            else:
+                yield self.types.AppendRowsRequest(offset=offset, arrow_rows=arrow_data)
+
+    def append_rows(self, stream_name: str, arrow_schema: bytes, arrow_batches: List[bytes],
+                    offsets: List[int]) -> Dict[int, List[str]]:
+        failed, received = dict(), 0
+        responses = self.client.append_rows(self._get_requests(stream_name, arrow_schema, arrow_batches, offsets))
+        # Responses come back in the order of the requests
+        for offset, response in zip(offsets, responses):
+            received += 1
+            errors = [row_error.message for row_error in response.row_errors]
+            if response.error.code and response.error.code != self.ALREADY_EXISTS:
+                errors.insert(0, response.error.message)
+            if errors:
+                failed[offset] = errors
+        for offset in offsets[received:]:
+            failed[offset] = ['No response received']
+        return failed
+
+    def finalize_stream(self, stream_name: str):
+        self.client.finalize_write_stream(name=stream_name)
+
+    def commit_streams(self, table_path: str, stream_names: List[str]) -> List[str]:
+        request = self.types.BatchCommitWriteStreamsRequest(parent=table_path, write_streams=stream_names)
+        response = self.client.batch_commit_write_streams(request)
+        return [stream_error.error_message for stream_error in response.stream_errors]
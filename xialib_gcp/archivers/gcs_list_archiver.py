@@ -10,18 +10,23 @@ from xialib_gcp.storers.gcs_storer import GCSStorer
 class GCSListArchiver(ListArchiver):
     """List archiver use Google Cloud Storage to save archive data
 
-    bucket-name will be "project_id-topic_id". Each table will have its own directory
+    bucket-name will be "project_id-topic_id". Each table will have its own directory.
+    A GCSStorer is created when no storer is given, its credentials are only resolved at first use
     """
-    def __init__(self, storer=GCSStorer(), **kwargs):
+    def __init__(self, storer: GCSStorer = None, **kwargs):
         super().__init__()
+        storer = GCSStorer() if storer is None else storer
         if not isinstance(storer, GCSStorer):
             self.logger.error("storer must be type of GCSStorer", extra=self.log_context)
             raise TypeError("XIA-000018")
         else:
-            self.project_id = storer.project_id
             self.storer = storer
             self.data_store = 'gcs'
 
+    @property
+    def project_id(self) -> str:
+        return self.storer.project_id
+
     def _get_filename(self, merge_key):
         return hashlib.md5(merge_key.encode()).hexdigest()[:4] + '-' + merge_key + '.zst'
 
@@ -54,5 +59,5 @@ class GCSListArchiver(ListArchiver):
                 self.workspace_size += list_size
 
     def remove_archives(self, merge_key_list: List[str]):
-        for merge_key in merge_key_list:
-            self.storer.remove(self.storer.join(self.table_path, self._get_filename(merge_key)))
+        self.storer.remove_many([self.storer.join(self.table_path, self._get_filename(merge_key))
+                                 for merge_key in merge_key_list])
@@ -1,3 +1,4 @@
 from xialib_gcp.depositors.firestore_depositor import FirestoreDepositor
+from xialib_gcp.depositors.async_firestore_depositor import AsyncFirestoreDepositor
 
-__all__ = ['FirestoreDepositor']
+__all__ = ['FirestoreDepositor', 'AsyncFirestoreDepositor']
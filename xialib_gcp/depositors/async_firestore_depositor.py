@@ -0,0 +1,179 @@
+import asyncio
+from collections import OrderedDict
+from typing import List
+from google.cloud import firestore
+from xialib_gcp.depositors.firestore_depositor import FirestoreDepositor, _DocumentHeader, _decode_chunks
+
+
+class AsyncFirestoreDepositor(FirestoreDepositor):
+    """Asyncio Firestore based depositor
+
+    Args:
+        db: Firestore asynchronous client
+        max_concurrency: maximum number of write requests in flight during ``commit``
+
+    Notes:
+        Writes of add_document / update_document / delete_documents are queued and only sent by ``commit``.
+        Writes of the same document keep their order, writes of different documents are sent concurrently.
+        A chunked document is written with its chunks by one write batch (several ones beyond ``batch_byte_limit``),
+        as by the synchronous depositor.
+        Queries are coroutines or async generators, so merge_documents is not supported by this depositor.
+        Cache, counter shards, batch_write, get_data_stream_by_sort_key and iter_data_from_header are not
+        supported either.
+    """
+    client_class = firestore.AsyncClient
+    unsupported_options = ['cache_size', 'cache_ttl', 'counter_shards', 'counter_ttl']
+
+    def __init__(self, db: firestore.AsyncClient, max_concurrency: int = 16, **kwargs):
+        unsupported = [key for key in self.unsupported_options if kwargs.get(key)]
+        super().__init__(db, **kwargs)
+        if unsupported:
+            self.logger.error("Options {} not supported by {}".format(unsupported, self.__class__.__name__),
+                              extra=self.log_context)
+            raise ValueError("XIA-010013")
+        self.max_concurrency = max_concurrency
+        self.pending_writes = list()
+
+    def _not_supported(self, method_name: str):
+        self.logger.error("{} not supported by {}".format(method_name, self.__class__.__name__),
+                          extra=self.log_context)
+        raise NotImplementedError("XIA-010013")
+
+    def batch_write(self):
+        self._not_supported('batch_write')
+
+    def commit_batch(self) -> bool:
+        self._not_supported('commit_batch')
+
+    def _get_counter_values(self, doc_ref: firestore.AsyncDocumentReference) -> dict:
+        self._not_supported('_get_counter_values')
+
+    def iter_data_from_header(self, header: dict, buffer_size: int = 2 ** 16):
+        self._not_supported('iter_data_from_header')
+
+    def get_data_stream_by_sort_key(self, *args, **kwargs):
+        self._not_supported('get_data_stream_by_sort_key')
+
+    def _write(self, operation: str, doc_ref: firestore.AsyncDocumentReference, content: dict = None):
+        self.pending_writes.append((operation, doc_ref, content))
+
+    def _write_group(self, write_list: list):
+        # Queued under the document path (the shortest one, chunks are in its sub-collection)
+        doc_ref = min([doc_ref for _, doc_ref, _ in write_list], key=lambda doc_ref: len(doc_ref.path))
+        for group in self._split_write_group(write_list):
+            self._write('batch', doc_ref, group)
+
+    async def _commit_document(self, semaphore: asyncio.Semaphore, write_list: list) -> bool:
+        for operation, doc_ref, content in write_list:
+            async with semaphore:
+                try:
+                    if operation == 'batch':
+                        batch = self.db.batch()
+                        for group_operation, group_ref, group_content in content:
+                            self._add_to_batch(batch, group_operation, group_ref, group_content)
+                        await batch.commit()
+                    elif operation == 'delete':
+                        await doc_ref.delete()
+                    elif operation == 'merge':
+                        await doc_ref.set(content, merge=True)
+                    else:
+                        await getattr(doc_ref, operation)(content)
+                except Exception as e:
+                    self.logger.error("Write {} failed: {}".format(doc_ref.path, e), extra=self.log_context)
+                    self.failed_writes[doc_ref.path] = format(e)
+                    return False
+        return True
+
+    async def commit(self) -> bool:
+        """Send all queued writes
+
+        Returns:
+            True if all writes are successful. Paths of failed documents are reported in ``failed_writes``
+        """
+        document_writes = OrderedDict()
+        for operation, doc_ref, content in self.pending_writes:
+            document_writes.setdefault(doc_ref.path, list()).append((operation, doc_ref, content))
+        self.pending_writes = list()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*[self._commit_document(semaphore, write_list)
+                                         for write_list in document_writes.values()])
+        return all(results)
+
+    async def _get_doc_ref(self, header: dict) -> firestore.AsyncDocumentReference:
+        doc_ref = getattr(header, 'reference', None)
+        if doc_ref is None:
+            doc_snapshot = await self.get_ref_by_merge_key(header['merge_key'])
+            doc_ref = doc_snapshot.reference
+        return doc_ref
+
+    async def _fetch_data(self, header: dict) -> dict:
+        doc_ref = await self._get_doc_ref(header)
+        doc_snapshot = await doc_ref.get(['data', 'data_encode', 'data_chunks'])
+        return _DocumentHeader(doc_snapshot.to_dict(), doc_ref)
+
+    async def _fetch_chunks(self, header: dict) -> List[bytes]:
+        chunk_nb = header.get('data_chunks', 1)
+        if chunk_nb <= 1:
+            return [header['data']]
+        doc_ref = await self._get_doc_ref(header)
+        chunk_dict = dict()
+        async for chunk in self.db.get_all([self._get_chunk_ref(doc_ref, i) for i in range(1, chunk_nb)]):
+            chunk_dict[chunk.id] = chunk.get('data')
+        return [header['data']] + [chunk_dict[str(i)] for i in range(1, chunk_nb)]
+
+    async def get_data_from_header(self, header: dict) -> List[dict]:
+        if 'data' not in header:
+            header = await self._fetch_data(header)
+        chunk_list = await self._fetch_chunks(header)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _decode_chunks, chunk_list, header.get('data_encode', None))
+
+    async def get_ref_by_merge_key(self, merge_key) -> firestore.DocumentSnapshot:
+        q = self.topic_object.where('table_id', '==', self.table_id).where('merge_key', '==', merge_key).limit(1)
+        async for ref in q.stream():
+            return ref
+
+    async def get_stream_by_sort_key(self,
+                                     status_list: List[str] = None,
+                                     le_ge_key: str = None,
+                                     reverse: bool = False,
+                                     min_merge_level: int = 0,
+                                     equal: bool = True,
+                                     select: List[str] = None,
+                                     header_only: bool = False):
+        if header_only and select is None:
+            select = self.header_fields
+        q = self._get_sort_key_query(status_list, le_ge_key, reverse, min_merge_level, equal, select)
+        client_filter = min_merge_level >= 3 and not self.server_level_filter
+        async for ref in q.stream():
+            # Min_merge_level >= 3 means the furthur filter is necessairy
+            if client_filter and ref.get('merge_level') < min_merge_level:
+                continue
+            yield ref
+
+    async def get_table_header(self, header_only: bool = False) -> firestore.DocumentSnapshot:
+        async for ref in self.get_stream_by_sort_key(['header'], reverse=True, header_only=header_only):
+            return ref
+
+    async def inc_table_header(self, **kwargs):
+        header_ref = await self.get_table_header()
+        header_dict = header_ref.to_dict()
+        content = kwargs.copy()
+        for key, value in content.items():
+            content[key] = firestore.Increment(value)
+            header_dict[key] = header_dict.get(key, 0) + value
+        # Sent at once, the writes queued by the caller are left to its own commit
+        await header_ref.reference.update(content)
+        return header_dict
+
+    async def migrate_merge_levels(self) -> int:
+        counter = 0
+        q = self.topic_object.where('table_id', '==', self.table_id).select(['merge_level', 'merge_levels'])
+        async for ref in q.stream():
+            doc_dict = ref.to_dict()
+            merge_levels = self._get_merge_levels(doc_dict['merge_level'])
+            if doc_dict.get('merge_levels', None) != merge_levels:
+                self._write('update', ref.reference, {'merge_levels': merge_levels})
+                counter += 1
+        await self.commit()
+        return counter
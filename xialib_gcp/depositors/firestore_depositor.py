@@ -1,23 +1,320 @@
+import io
 import os
 import json
+import codecs
 import base64
 import gzip
+import time
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from typing import List, Dict, Any, Union, Generator
 from google.cloud import firestore
 from xialib.depositor import Depositor
 
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # pragma: no cover
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None  # pragma: no cover
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # pragma: no cover
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None  # pragma: no cover
+
+
+def _zstd_compress(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data: bytes) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _raw(data: bytes) -> bytes:
+    return data
+
+
+def _json_dumps(data: List[dict]) -> bytes:
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+def _json_loads(data: bytes) -> List[dict]:
+    return orjson.loads(data) if orjson else json.loads(data.decode())
+
+
+def _ndjson_dumps(data: List[dict]) -> bytes:
+    return '\n'.join([json.dumps(record, ensure_ascii=False) for record in data]).encode()
+
+
+def _ndjson_loads(data: bytes) -> List[dict]:
+    return [_json_loads(line) for line in data.split(b'\n') if line]
+
+
+def _msgpack_dumps(data: List[dict]) -> bytes:
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _msgpack_loads(data: bytes) -> List[dict]:
+    return msgpack.unpackb(data, raw=False)
+
+
+# codec name: (compress, decompress), None if the package is not installed
+payload_codecs = {
+    'gzip': (gzip.compress, gzip.decompress),
+    'zstd': (_zstd_compress, _zstd_decompress) if zstandard else (None, None),
+    'lz4': (lz4.frame.compress, lz4.frame.decompress) if lz4 else (None, None),
+    'raw': (_raw, _raw),
+}
+
+# serializer name: (dumps, loads), None if the package is not installed. orjson documents are tagged as json
+payload_serializers = {
+    'json': (_json_dumps, _json_loads),
+    'orjson': (orjson.dumps, _json_loads) if orjson else (None, None),
+    'ndjson': (_ndjson_dumps, _ndjson_loads),
+    'msgpack': (_msgpack_dumps, _msgpack_loads) if msgpack else (None, None),
+}
+
+
+def _zstd_stream(data: bytes):
+    return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+
+
+def _lz4_stream(data: bytes):
+    return lz4.frame.LZ4FrameFile(io.BytesIO(data), mode='rb')
+
+
+def _gzip_stream(data: bytes):
+    return gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb')
+
+
+# codec name: function to open a decompression stream
+payload_streams = {
+    'gzip': _gzip_stream,
+    'zstd': _zstd_stream,
+    'lz4': _lz4_stream,
+    'raw': io.BytesIO,
+}
+
+
+def _iter_json(stream, buffer_size: int):
+    """Parse a json list of records block by block"""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer, pos = '', 0
+    while True:
+        block = stream.read(buffer_size)
+        buffer = buffer[pos:] + text_decoder.decode(block, final=not block)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,[':
+                pos += 1
+            if pos >= len(buffer) or buffer[pos] == ']':
+                break
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if not block:
+                    raise
+                break
+            yield record
+        if not block:
+            return
+
+
+def _iter_ndjson(stream, buffer_size: int):
+    """Parse newline delimited json records block by block"""
+    buffer = b''
+    while True:
+        block = stream.read(buffer_size)
+        lines = (buffer + block).split(b'\n')
+        buffer = lines.pop() if block else b''
+        for line in lines:
+            if line:
+                yield _json_loads(line)
+        if not block:
+            return
+
+
+def _iter_msgpack(stream, buffer_size: int):
+    unpacker = msgpack.Unpacker(stream, read_size=buffer_size, raw=False)
+    for _ in range(unpacker.read_array_header()):
+        yield unpacker.unpack()
+
+
+# serializer name: function to parse records one by one from a stream
+payload_iterators = {
+    'json': _iter_json,
+    'ndjson': _iter_ndjson,
+    'msgpack': _iter_msgpack,
+}
+
+
+def _get_payload_encode(codec: str, serializer: str) -> str:
+    serializer = 'json' if serializer == 'orjson' else serializer
+    return codec if serializer == 'json' else codec + '+' + serializer
+
+
+def _split_payload_encode(data_encode: str):
+    """Get codec and serializer of a document, documents with unknown encode are gzip compressed json"""
+    codec, _, serializer = (data_encode or '').partition('+')
+    if codec not in payload_codecs or (serializer and serializer not in payload_serializers):
+        return 'gzip', 'json'
+    return codec, serializer if serializer else 'json'
+
+
+def _decode_payload(data: bytes, data_encode: str) -> List[dict]:
+    codec, serializer = _split_payload_encode(data_encode)
+    return payload_serializers[serializer][1](payload_codecs[codec][1](data))
+
+
+def _decode_chunks(chunk_list: List[bytes], data_encode: str) -> List[dict]:
+    data = list()
+    for chunk in chunk_list:
+        data.extend(_decode_payload(chunk, data_encode))
+    return data
+
+
+class _LRUCache:
+    """Least recently used cache bounded by the total size of its items, with an optional time to live"""
+    def __init__(self, max_size: int, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key, None)
+        if item is None:
+            return None
+        value, size, expire_time = item
+        if expire_time is not None and expire_time < time.monotonic():
+            self.pop(key)
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value, size: int):
+        self.pop(key)
+        if size > self.max_size:
+            return
+        expire_time = time.monotonic() + self.ttl if self.ttl else None
+        self.items[key] = (value, size, expire_time)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, old_size, _) = self.items.popitem(last=False)
+            self.size -= old_size
+
+    def pop(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+
+class _DocumentHeader(dict):
+    """Document content with the reference of the document, so that the data can be fetched afterwards"""
+    def __init__(self, content: dict, reference: firestore.DocumentReference):
+        super().__init__(content)
+        self.reference = reference
+
 
 class FirestoreDepositor(Depositor):
+    """Firestore based depositor
+
+    Args:
+        db: Firestore client
+        cache_size: maximum bytes of table headers and decoded data kept in memory, 0 means no cache
+        cache_ttl: seconds before a cached item expires, None means items only expire by own writes
+        codec: compression of stored payloads, one of ``payload_codecs`` (gzip, zstd, lz4, raw)
+        serializer: serialization of stored payloads, one of ``payload_serializers`` (json, orjson, ndjson, msgpack)
+        server_level_filter: filter ``min_merge_level >= 3`` in the query instead of in the client
+        counter_shards: number of counter shards of the table header, 0 means counters are saved in the header
+        counter_ttl: seconds during which the sum of counter shards is cached, 0 means no cache
+        header_fields: fields downloaded by the header only queries in addition to the class ``header_fields``
+
+    Notes:
+        The cache is only invalidated by the writes of the depositor itself. Records returned from the cache
+        are shared between the calls and must be considered as read-only.
+
+        Firestore projections can only list the fields to download, so header only queries return the fields of
+        ``header_fields``. Other fields of the documents, such as meta-data or custom counters of the table
+        header, are missing from their headers unless they are added by the ``header_fields`` argument.
+
+        The payload encode is saved as ``data_encode`` of each document (for example ``zstd+msgpack``),
+        so documents written with another codec stay readable.
+
+        Payloads larger than ``size_limit * chunk_fill_rate`` are split into chunks, so that the other fields still
+        fit in the document. The first chunk is saved in the document and the others in its ``chunks``
+        sub-collection, ``data_chunks`` holds the number of chunks. A document and its chunks are written by one
+        batch, or by several ones (chunks first) when they exceed ``batch_byte_limit``.
+
+        With counter shards, inc_table_header increments a random document of the ``counters`` sub-collection of
+        the table header, the values are added to the header by get_header_from_ref. The counter fields must then
+        only be changed by inc_table_header.
+
+        Each document holds ``merge_levels``, the list of min_merge_level values it satisfies. The server side
+        filter needs a composite index (table_id, filter_key, merge_levels, sort_key) and documents written by the
+        previous versions must be completed by ``migrate_merge_levels`` before activating it.
+    """
     data_encode = 'gzip'
     size_limit = 2 ** 20
+    batch_limit = 500  # Firestore limit of operations in one write batch
+    batch_byte_limit = 9 * 2 ** 20  # Below Firestore limit of 10 MiB of one commit request
+    chunk_fill_rate = 0.9  # Maximum payload of a document or a chunk compared to size_limit
+    client_class = firestore.Client
+    # Fields downloaded by the header only queries
+    header_fields = ['topic_id', 'table_id', 'aged', 'age', 'end_age', 'start_seq', 'sort_key', 'merge_key',
+                     'merge_level', 'merge_levels', 'merge_status', 'line_nb', 'data_size', 'data_encode',
+                     'data_chunks', 'data_format', 'data_spec', 'data_store', 'filter_key', 'merged_size',
+                     'packaged_size']
 
-    def __init__(self, db: firestore.Client):
+    def __init__(self, db: firestore.Client, cache_size: int = 0, cache_ttl: float = None,
+                 codec: str = 'gzip', serializer: str = 'json', server_level_filter: bool = False,
+                 counter_shards: int = 0, counter_ttl: float = 0, header_fields: List[str] = None):
         super().__init__()
-        if not isinstance(db, firestore.Client):
-            self.logger.error("FirestoreDepositor db must be type of Firestore Client", extra=self.log_context)
+        if not isinstance(db, self.client_class):
+            self.logger.error("{} db must be type of {}".format(self.__class__.__name__, self.client_class.__name__),
+                              extra=self.log_context)
             raise TypeError("XIA-010003")
         else:
             self.db = db
+        if codec not in payload_codecs or serializer not in payload_serializers:
+            self.logger.error("Payload codec {} / serializer {} not supported".format(codec, serializer),
+                              extra=self.log_context)
+            raise ValueError("XIA-010006")
+        if payload_codecs[codec][0] is None or payload_serializers[serializer][0] is None:
+            self.logger.error("Package of codec {} / serializer {} not installed".format(codec, serializer),
+                              extra=self.log_context)
+            raise ImportError("XIA-010007")
+        self.payload_codec = codec
+        self.payload_serializer = serializer
+        self.payload_encode = _get_payload_encode(codec, serializer)
+        self.server_level_filter = server_level_filter
+        self.counter_shards = counter_shards
+        self.counter_cache = _LRUCache(2 ** 10, counter_ttl) if counter_ttl > 0 else None
+        self.batch = None
+        self.batch_paths = list()
+        self.batch_bytes = 0
+        self.batch_error = None
+        self.batch_cache_keys = set()
+        self.failed_writes = dict()
+        self.cache = _LRUCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self.records = None
+        if header_fields:
+            self.header_fields = self.header_fields + [field for field in header_fields
+                                                       if field not in self.header_fields]
 
     def _get_filter_key(self, merge_status, merge_level):
         """Get Filter Key for Firestore
@@ -39,26 +336,248 @@ class FirestoreDepositor(Depositor):
         elif merge_status == 'initial':
             return min(3, merge_level)
 
+    def _get_merge_levels(self, merge_level: int) -> List[int]:
+        return list(range(merge_level + 1))
+
     def _set_current_topic_table(self, topic_id: str, table_id: str):
         self.topic_id = topic_id
         self.table_id = table_id
         self.topic_object = self.db.collection(topic_id)
 
-    def _add_document(self, header: dict, data: bytes) -> dict:
+    def _invalidate_cache(self, doc_dict: dict):
+        if self.cache is None or not doc_dict:
+            return
+        cache_keys = [('data', self.topic_id, self.table_id, doc_dict.get('merge_key', None))]
+        if doc_dict.get('merge_status', None) == 'header':
+            cache_keys.append(('header', self.topic_id, self.table_id, False))
+            cache_keys.append(('header', self.topic_id, self.table_id, True))
+        if self.batch is not None:
+            # Items read before the batch is committed are stale, they are removed again at each commit
+            self.batch_cache_keys.update(cache_keys)
+        for cache_key in cache_keys:
+            self.cache.pop(cache_key)
+
+    @contextmanager
+    def batch_write(self):
+        """Group all document writes of the context into Firestore write batches
+
+        A batch is committed each time it reaches ``batch_limit`` operations or ``batch_byte_limit`` bytes and
+        when the context exits. The writes of a batch are atomic. Once a batch has failed, the following batches
+        of the context are dropped, so a write can't be committed when the writes it depends on are lost.
+        Document paths of the failed and dropped batches are reported in ``failed_writes``, which is cleared when
+        the outermost context is entered, and the error of the failed batch is raised when the context exits.
+
+        Notes:
+            Documents written inside the context are not visible to the queries before the batch is committed
+        """
+        if self.batch is not None:
+            yield self
+            return
+        self.batch = self.db.batch()
+        self.batch_error = None
+        self.failed_writes = dict()
+        try:
+            yield self
+        finally:
+            self.commit_batch()
+            self.batch = None
+            self.batch_cache_keys = set()
+        if self.batch_error is not None:
+            raise self.batch_error
+
+    def commit_batch(self) -> bool:
+        if self.batch is None or not self.batch_paths:
+            return True
+        batch, batch_paths = self.batch, self.batch_paths
+        self.batch, self.batch_paths, self.batch_bytes = self.db.batch(), list(), 0
+        if self.batch_error is not None:
+            self.logger.error("Batch of {} writes dropped after a failed batch".format(len(batch_paths)),
+                              extra=self.log_context)
+            for doc_path in batch_paths:
+                self.failed_writes[doc_path] = "Dropped after a failed batch"
+            return False
+        try:
+            batch.commit()
+        except Exception as e:
+            self.logger.error("Batch of {} writes failed: {}".format(len(batch_paths), e), extra=self.log_context)
+            for doc_path in batch_paths:
+                self.failed_writes[doc_path] = format(e)
+            self.batch_error = e
+            return False
+        finally:
+            if self.cache is not None:
+                for cache_key in self.batch_cache_keys:
+                    self.cache.pop(cache_key)
+        return True
+
+    def _get_write_size(self, doc_ref: firestore.DocumentReference, content: dict = None) -> int:
+        """Estimated size of a write in a commit request: document path, field names and values"""
+        write_size = len(doc_ref.path) + 16
+        for key, value in (content or dict()).items():
+            write_size += len(key) + (len(value) if isinstance(value, (bytes, str)) else 16)
+        return write_size
+
+    def _add_to_batch(self, batch: firestore.WriteBatch, operation: str, doc_ref: firestore.DocumentReference,
+                      content: dict = None):
+        if operation == 'delete':
+            batch.delete(doc_ref)
+        elif operation == 'merge':
+            batch.set(doc_ref, content, merge=True)
+        else:
+            getattr(batch, operation)(doc_ref, content)
+
+    def _write(self, operation: str, doc_ref: firestore.DocumentReference, content: dict = None):
+        if self.batch is None:
+            if operation == 'delete':
+                doc_ref.delete()
+            elif operation == 'merge':
+                doc_ref.set(content, merge=True)
+            else:
+                getattr(doc_ref, operation)(content)
+            return
+        write_size = self._get_write_size(doc_ref, content)
+        if self.batch_paths and self.batch_bytes + write_size > self.batch_byte_limit:
+            self.commit_batch()
+        self._add_to_batch(self.batch, operation, doc_ref, content)
+        self.batch_paths.append(doc_ref.path)
+        self.batch_bytes += write_size
+        if len(self.batch_paths) >= self.batch_limit:
+            self.commit_batch()
+
+    def _split_write_group(self, write_list: list) -> List[list]:
+        """Split writes into lists of at most ``batch_limit`` operations and ``batch_byte_limit`` bytes"""
+        group_list, group_bytes = [[]], 0
+        for operation, doc_ref, content in write_list:
+            write_size = self._get_write_size(doc_ref, content)
+            if group_list[-1] and (len(group_list[-1]) >= self.batch_limit or
+                                   group_bytes + write_size > self.batch_byte_limit):
+                group_list.append(list())
+                group_bytes = 0
+            group_list[-1].append((operation, doc_ref, content))
+            group_bytes += write_size
+        return group_list
+
+    def _write_group(self, write_list: list):
+        """Write a document and its chunks in one write batch, or in several ones if it exceeds the limits
+
+        Outside of batch_write, the groups are committed at once and errors are raised as for a single write.
+        Inside, the pending batch is committed first when a group doesn't fit in it.
+        The document is the last write of the list, so it is only visible when its chunks are written.
+        """
+        for group in self._split_write_group(write_list):
+            if self.batch is None:
+                batch = self.db.batch()
+                for operation, doc_ref, content in group:
+                    self._add_to_batch(batch, operation, doc_ref, content)
+                batch.commit()
+                continue
+            group_bytes = sum([self._get_write_size(doc_ref, content) for _, doc_ref, content in group])
+            if self.batch_paths and (len(self.batch_paths) + len(group) > self.batch_limit or
+                                     self.batch_bytes + group_bytes > self.batch_byte_limit):
+                self.commit_batch()
+            for operation, doc_ref, content in group:
+                self._write(operation, doc_ref, content)
+
+    def add_document(self, header: dict, data: List[dict]):
+        # Records are kept so that the payload is encoded from them and not from the gzip json of depositor
+        self.records = data
+        try:
+            return super().add_document(header, data)
+        finally:
+            self.records = None
+
+    def update_document(self, ref: firestore.DocumentSnapshot, header: dict, data: List[dict] = None):
+        self.records = data
+        try:
+            return super().update_document(ref, header, data)
+        finally:
+            self.records = None
+
+    def _encode_data(self, records: List[dict]) -> bytes:
+        return payload_codecs[self.payload_codec][0](payload_serializers[self.payload_serializer][0](records))
+
+    def _split_records(self, records: List[dict], payload_size: int) -> List[bytes]:
+        """Split records into encoded chunks of similar size
+
+        The chunk number is estimated by the size of the whole payload and the records are distributed by their
+        serialized size, so each record is compressed only once
+        """
+        dumps, compress = payload_serializers[self.payload_serializer][0], payload_codecs[self.payload_codec][0]
+        record_sizes = [len(dumps([record])) for record in records]
+        chunk_nb = -(-payload_size // self._get_payload_limit())
+        target_size = sum(record_sizes) / chunk_nb
+        group_list, start, current_size = list(), 0, 0
+        for i, record_size in enumerate(record_sizes):
+            current_size += record_size
+            if current_size >= target_size and i + 1 < len(records):
+                group_list.append(records[start: i + 1])
+                start, current_size = i + 1, 0
+        group_list.append(records[start:])
+        chunk_list = list()
+        for group in group_list:
+            chunk = compress(dumps(group))
+            if len(chunk) > self._get_payload_limit() and len(group) > 1:
+                chunk_list.extend(self._split_records(group, len(chunk)))  # pragma: no cover
+            else:
+                chunk_list.append(chunk)
+        return chunk_list
+
+    def _get_payload_limit(self) -> int:
+        """Maximum payload of a document, the rest of size_limit is left to the other fields"""
+        return int(self.size_limit * self.chunk_fill_rate)
+
+    def _encode_chunks(self, data: bytes) -> List[bytes]:
+        """Encode the payload and split it into chunks no larger than the payload limit
+
+        The gzip json payload of depositor is kept as it is when it is already in the payload encode and fits.
+        Otherwise the records are encoded once, they are only parsed from the payload if not given by the caller
+        """
+        payload_limit = self._get_payload_limit()
+        if self.payload_encode == self.data_encode and len(data) <= payload_limit:
+            return [data]
+        records = self.records if self.records is not None else _json_loads(gzip.decompress(data))
+        payload = data if self.payload_encode == self.data_encode else self._encode_data(records)
+        if len(payload) <= payload_limit:
+            return [payload]
+        return self._split_records(records, len(payload))
+
+    def _get_chunk_ref(self, doc_ref: firestore.DocumentReference, chunk_no: int) -> firestore.DocumentReference:
+        return doc_ref.collection('chunks').document(str(chunk_no))
+
+    def _write_document(self, operation: str, doc_ref: firestore.DocumentReference, header: dict, data: bytes,
+                        old_chunk_nb: int = 1) -> dict:
+        chunk_list = self._encode_chunks(data)
         content = header.copy()
-        content['data'] = data
-        content['data_size'] = len(content['data'])
+        content['data'] = chunk_list[0]
+        content['data_encode'] = self.payload_encode
+        content['data_size'] = sum([len(chunk) for chunk in chunk_list])
         content['filter_key'] = self._get_filter_key(content['merge_status'], content['merge_level'])
-        self.topic_object.add(content)
+        content['merge_levels'] = self._get_merge_levels(content['merge_level'])
+        if len(chunk_list) > 1:
+            content['data_chunks'] = len(chunk_list)
+        else:
+            content.pop('data_chunks', None)
+        if len(chunk_list) == 1 and old_chunk_nb <= 1:
+            self._write(operation, doc_ref, content)
+            return content
+        # Chunks are written before the document and stale chunks are deleted after it
+        write_list = [('set', self._get_chunk_ref(doc_ref, i), {'data': chunk_list[i]})
+                      for i in range(1, len(chunk_list))]
+        write_list.append((operation, doc_ref, content))
+        write_list.extend([('delete', self._get_chunk_ref(doc_ref, i), None)
+                           for i in range(len(chunk_list), old_chunk_nb)])
+        self._write_group(write_list)
         return content
 
+    def _add_document(self, header: dict, data: bytes) -> dict:
+        self._invalidate_cache(header)
+        return self._write_document('create', self.topic_object.document(), header, data)
+
     def _update_document(self, ref: firestore.DocumentSnapshot, header: dict, data: bytes):
-        content = header.copy()
-        content['data'] = data
-        content['data_size'] = len(content['data'])
-        content['filter_key'] = self._get_filter_key(content['merge_status'], content['merge_level'])
-        ref.reference.set(content)
-        return content
+        doc_content = ref.to_dict()
+        self._invalidate_cache(doc_content)
+        self._invalidate_cache(header)
+        return self._write_document('set', ref.reference, header, data, doc_content.get('data_chunks', 1))
 
     def _update_header(self, ref: firestore.DocumentSnapshot, header: dict):
         content = header.copy()
@@ -73,31 +592,117 @@ class FirestoreDepositor(Depositor):
                 content[key] = firestore.DELETE_FIELD
             else:
                 doc_content[key] = value
-        ref.reference.update(content)
+        if isinstance(content.get('merge_level', None), int):
+            content['merge_levels'] = self._get_merge_levels(content['merge_level'])
+            doc_content['merge_levels'] = content['merge_levels']
+        self._invalidate_cache(doc_content)
+        self._write('update', ref.reference, content)
         return doc_content
 
     def delete_documents(self, ref_list: List[firestore.DocumentSnapshot]):
         for ref in ref_list:
-            ref.reference.delete()
+            doc_content = ref.to_dict()
+            self._invalidate_cache(doc_content)
+            for i in range(1, doc_content.get('data_chunks', 1)):
+                self._write('delete', self._get_chunk_ref(ref.reference, i))
+            if doc_content.get('merge_status', None) == 'header':
+                for i in range(self.counter_shards):
+                    self._write('delete', self._get_counter_ref(ref.reference, i))
+            self._write('delete', ref.reference)
         return True
 
+    def _get_counter_ref(self, doc_ref: firestore.DocumentReference, shard_no: int) -> firestore.DocumentReference:
+        return doc_ref.collection('counters').document(str(shard_no))
+
+    def _get_counter_values(self, doc_ref: firestore.DocumentReference) -> dict:
+        """Get the sum of all counter shards of a table header"""
+        if self.counter_cache is not None:
+            counter_values = self.counter_cache.get(doc_ref.path)
+            if counter_values is not None:
+                return counter_values
+        counter_values = dict()
+        for shard in doc_ref.collection('counters').stream():
+            for key, value in shard.to_dict().items():
+                counter_values[key] = counter_values.get(key, 0) + value
+        if self.counter_cache is not None:
+            self.counter_cache.put(doc_ref.path, counter_values, 1)
+        return counter_values
+
     def get_header_from_ref(self, doc_ref: firestore.DocumentSnapshot) -> dict:
-        return doc_ref.to_dict()
+        header = _DocumentHeader(doc_ref.to_dict(), doc_ref.reference)
+        if self.counter_shards > 0 and header.get('merge_status', None) == 'header':
+            for key, value in self._get_counter_values(doc_ref.reference).items():
+                header[key] = header.get(key, 0) + value
+        return header
+
+    def _fetch_data(self, header: dict) -> dict:
+        """Fetch payload of a header which is got by a header only query"""
+        doc_ref = getattr(header, 'reference', None)
+        if doc_ref is None:
+            doc_ref = self.get_ref_by_merge_key(header['merge_key']).reference
+        return _DocumentHeader(doc_ref.get(['data', 'data_encode', 'data_chunks']).to_dict(), doc_ref)
+
+    def _fetch_chunks(self, header: dict) -> List[bytes]:
+        """Get all payload chunks of a document, the chunks after the first one are fetched in one request"""
+        chunk_nb = header.get('data_chunks', 1)
+        if chunk_nb <= 1:
+            return [header['data']]
+        doc_ref = getattr(header, 'reference', None)
+        if doc_ref is None:
+            doc_ref = self.get_ref_by_merge_key(header['merge_key']).reference
+        chunk_dict = {chunk.id: chunk.get('data') for chunk in
+                      self.db.get_all([self._get_chunk_ref(doc_ref, i) for i in range(1, chunk_nb)])}
+        return [header['data']] + [chunk_dict[str(i)] for i in range(1, chunk_nb)]
 
     def get_data_from_header(self, header: dict) -> List[dict]:
-        return json.loads(gzip.decompress(header['data']).decode())
+        """Get decoded data of a document
+
+        The payload is fetched at first access if the header has no data and the chunks are reassembled
+        """
+        if self.cache is None or header.get('merge_key', None) is None:
+            if 'data' not in header:
+                header = self._fetch_data(header)
+            return _decode_chunks(self._fetch_chunks(header), header.get('data_encode', None))
+        cache_key = ('data', self.topic_id, self.table_id, header['merge_key'])
+        cached_item = self.cache.get(cache_key)
+        if cached_item is not None and cached_item[0] == header.get('data_size', None):
+            return list(cached_item[1])
+        data_size = header.get('data_size', None)
+        if 'data' not in header:
+            header = self._fetch_data(header)
+        codec, serializer = _split_payload_encode(header.get('data_encode', None))
+        data, raw_size = list(), 0
+        for chunk in self._fetch_chunks(header):
+            raw_data = payload_codecs[codec][1](chunk)
+            data.extend(payload_serializers[serializer][1](raw_data))
+            raw_size += len(raw_data)
+        self.cache.put(cache_key, (data_size, data), raw_size)
+        return list(data)
+
+    def iter_data_from_header(self, header: dict, buffer_size: int = 2 ** 16) -> Generator[dict, None, None]:
+        """Yield the records of a document one by one
+
+        The payload is decompressed and parsed by blocks of ``buffer_size`` bytes, so the whole record list is
+        never materialized. The ndjson serializer is the fastest one to be parsed this way.
+        """
+        if 'data' not in header:
+            header = self._fetch_data(header)
+        codec, serializer = _split_payload_encode(header.get('data_encode', None))
+        for chunk in self._fetch_chunks(header):
+            yield from payload_iterators[serializer](payload_streams[codec](chunk), buffer_size)
 
     def get_ref_by_merge_key(self, merge_key) -> firestore.DocumentSnapshot:
         q = self.topic_object.where('table_id', '==', self.table_id).where('merge_key', '==', merge_key).limit(1)
         for ref in q.stream():
             return ref
 
-    def get_stream_by_sort_key(self,
-                               status_list: List[str] = None,
-                               le_ge_key: str = None,
-                               reverse: bool = False,
-                               min_merge_level: int = 0,
-                               equal: bool = True):
+    def _get_sort_key_query(self,
+                            status_list: List[str] = None,
+                            le_ge_key: str = None,
+                            reverse: bool = False,
+                            min_merge_level: int = 0,
+                            equal: bool = True,
+                            select: List[str] = None) -> firestore.Query:
         white_list = list()
         initial_merge_level_dict = {x: [i for i in range(4) if i >= x] for x in range(4)}
         merged_merge_level_dict = {x + 4: [i + 4 for i in range(4) if i >= x] for x in range(4)}
@@ -137,24 +742,138 @@ class FirestoreDepositor(Depositor):
                 q = self.topic_object.where('table_id', '==', self.table_id) \
                     .where('filter_key', 'in', white_list) \
                     .where('sort_key', '>', le_ge_key).order_by('sort_key')
+        if min_merge_level >= 3 and self.server_level_filter:
+            q = q.where('merge_levels', 'array_contains', min_merge_level)
+        if select is not None:
+            q = q.select(list(set(select) | {'merge_level', 'sort_key'}))
+        return q
+
+    def get_stream_by_sort_key(self,
+                               status_list: List[str] = None,
+                               le_ge_key: str = None,
+                               reverse: bool = False,
+                               min_merge_level: int = 0,
+                               equal: bool = True,
+                               select: List[str] = None,
+                               header_only: bool = False):
+        """Get documents of current table ordered by sort_key
+
+        Args:
+            status_list: merge status to be selected (header, initial, merged, packaged)
+            le_ge_key: sort_key lower (reverse) or greater than this value
+            reverse: descending order of sort_key
+            min_merge_level: only documents whose merge_level is at least this value
+            equal: le_ge_key is included
+            select: only the listed fields are downloaded (projection)
+            header_only: only ``header_fields`` are downloaded, data is fetched by get_data_from_header if needed
+        """
+        if header_only and select is None:
+            select = self.header_fields
+        q = self._get_sort_key_query(status_list, le_ge_key, reverse, min_merge_level, equal, select)
+        client_filter = min_merge_level >= 3 and not self.server_level_filter
         for ref in q.stream():
             # Min_merge_level >= 3 means the furthur filter is necessairy
-            if min_merge_level >= 3:
-                doc_dict = self.get_header_from_ref(ref)
-                if doc_dict['merge_level'] < min_merge_level:
-                    continue
+            if client_filter and ref.get('merge_level') < min_merge_level:
+                continue
             yield ref
 
-    def get_table_header(self) -> firestore.DocumentSnapshot:
-        for ref in self.get_stream_by_sort_key(['header'], reverse=True):
-            return ref
+    def migrate_merge_levels(self) -> int:
+        """Add merge_levels field to the documents of current table which are written by the previous versions
+
+        Returns:
+            number of migrated documents
+        """
+        counter = 0
+        q = self.topic_object.where('table_id', '==', self.table_id).select(['merge_level', 'merge_levels'])
+        with self.batch_write():
+            for ref in q.stream():
+                doc_dict = ref.to_dict()
+                merge_levels = self._get_merge_levels(doc_dict['merge_level'])
+                if doc_dict.get('merge_levels', None) != merge_levels:
+                    self._write('update', ref.reference, {'merge_levels': merge_levels})
+                    counter += 1
+        return counter
+
+    def get_data_stream_by_sort_key(self,
+                                    status_list: List[str] = None,
+                                    le_ge_key: str = None,
+                                    reverse: bool = False,
+                                    min_merge_level: int = 0,
+                                    equal: bool = True,
+                                    page_size: int = 50,
+                                    max_workers: int = 4,
+                                    use_process: bool = False):
+        """Same as get_stream_by_sort_key but yield (document, header, data) with the payload already decoded
+
+        The query is read page by page with cursors. The next page is fetched in background while the chunks
+        of the current page are fetched and decoded by a thread pool (decoding is done by a process pool if
+        ``use_process`` is set). The look-ahead is bounded by one page in fetch and ``page_size`` payloads
+        in decoding. Items are always yielded in the sort_key order.
+        """
+        q = self._get_sort_key_query(status_list, le_ge_key, reverse, min_merge_level, equal)
+        client_filter = min_merge_level >= 3 and not self.server_level_filter
+        process_context = ProcessPoolExecutor(max_workers=max_workers) if use_process else nullcontext()
+        with ThreadPoolExecutor(max_workers=1) as fetch_pool, \
+                ThreadPoolExecutor(max_workers=max_workers) as decode_pool, process_context as process_pool:
+            next_page = fetch_pool.submit(self._get_page, q, None, page_size)
+            while next_page is not None:
+                page = next_page.result()
+                if len(page) == page_size:
+                    next_page = fetch_pool.submit(self._get_page, q, page[-1], page_size)
+                else:
+                    next_page = None
+                pending = deque()
+                for ref in page:
+                    doc_dict = self.get_header_from_ref(ref)
+                    # Min_merge_level >= 3 means the furthur filter is necessairy
+                    if client_filter and doc_dict['merge_level'] < min_merge_level:
+                        continue
+                    future = decode_pool.submit(self._fetch_decode_chunks, doc_dict, process_pool)
+                    pending.append((ref, doc_dict, future))
+                while pending:
+                    ref, doc_dict, future = pending.popleft()
+                    yield ref, doc_dict, future.result()
+
+    def _fetch_decode_chunks(self, header: dict, process_pool: ProcessPoolExecutor = None) -> List[dict]:
+        # Chunks are fetched in the thread, only the decoding could be sent to another process
+        chunk_list = self._fetch_chunks(header)
+        if process_pool is None:
+            return _decode_chunks(chunk_list, header.get('data_encode', None))
+        return process_pool.submit(_decode_chunks, chunk_list, header.get('data_encode', None)).result()
+
+    def _get_page(self, q: firestore.Query, cursor: firestore.DocumentSnapshot, page_size: int) -> list:
+        if cursor is not None:
+            q = q.start_after(cursor)
+        return [ref for ref in q.limit(page_size).stream()]
+
+    def get_table_header(self, header_only: bool = False) -> firestore.DocumentSnapshot:
+        if self.cache is None:
+            for ref in self.get_stream_by_sort_key(['header'], reverse=True, header_only=header_only):
+                return ref
+            return None
+        cache_key = ('header', self.topic_id, self.table_id, header_only)
+        header_ref = self.cache.get(cache_key)
+        if header_ref is None:
+            for ref in self.get_stream_by_sort_key(['header'], reverse=True, header_only=header_only):
+                header_ref = ref
+                self.cache.put(cache_key, ref, len(ref.to_dict().get('data', b'')))
+                break
+        return header_ref
 
     def inc_table_header(self, **kwargs):
         header_ref = self.get_table_header()
-        header_dict = header_ref.to_dict()
+        header_dict = self.get_header_from_ref(header_ref)
         content = kwargs.copy()
         for key, value in content.items():
             content[key] = firestore.Increment(value)
             header_dict[key] = header_dict.get(key, 0) + value
-        self.update_document(header_ref, content)
+        if self.counter_shards <= 0:
+            self.update_document(header_ref, content)
+            return header_dict
+        shard_ref = self._get_counter_ref(header_ref.reference, random.randrange(self.counter_shards))
+        self._write('merge', shard_ref, content)
+        counter_values = self.counter_cache.get(header_ref.reference.path) if self.counter_cache else None
+        if counter_values is not None:
+            for key, value in kwargs.items():
+                counter_values[key] = counter_values.get(key, 0) + value
         return header_dict
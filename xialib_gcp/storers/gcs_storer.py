@@ -1,19 +1,122 @@
 import io
 import os
-import google.auth
-import gcsfs
+import mmap
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from xialib.storer import IOStorer
 
+
+class _DiskCache:
+    """Least recently used cache of immutable files in a local directory, bounded by the total file size"""
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Temporary files left by an interrupted put are removed
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith('.tmp'):
+                self._remove_file(entry.path)
+        # Files kept by a previous run are reused, the least recently accessed are evicted first
+        cached_files = [entry for entry in os.scandir(directory) if entry.is_file() and '.' not in entry.name]
+        for entry in sorted(cached_files, key=lambda x: x.stat().st_atime):
+            self.items[entry.name] = entry.stat().st_size
+            self.size += entry.stat().st_size
+        self._evict()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> str:
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self._get_path(key)
+
+    def put(self, key: str, data: bytes) -> str:
+        if len(data) > self.max_size:
+            return None
+        temp_path = '{}.{}.tmp'.format(self._get_path(key), uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as fp:
+                fp.write(data)
+            os.replace(temp_path, self._get_path(key))
+        except FileNotFoundError as e:  # pragma: no cover
+            return None  # pragma: no cover
+        with self.lock:
+            self.size -= self.items.pop(key, 0)
+            self.items[key] = len(data)
+            self.size += len(data)
+            self._evict()
+        return self._get_path(key)
+
+    def _remove_file(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError as e:  # pragma: no cover
+            pass  # pragma: no cover
+
+    def _evict(self):
+        while self.size > self.max_size:
+            key, size = self.items.popitem(last=False)
+            self.size -= size
+            self._remove_file(self._get_path(key))
+
+
 class GCSStorer(IOStorer):
     """Google Cloud Plateform Based
+
+    Args:
+        fs: file system object, a gcsfs.GCSFileSystem is created with the other keyword arguments at first use
+        project_id: project id, resolved from the default credentials at first use
+        part_size: files larger than part size are uploaded by parts then composed and downloaded by ranges
+        max_workers: number of parts or ranges transferred concurrently
+        cache_dir: local directory of the read-through cache, files are only read from GCS at the first time
+        cache_size: maximum total size of the files of the read-through cache
     """
     store_types = ['gcs']
+    compose_limit = 32  # Maximum source objects of one compose request
 
-    def __init__(self, **kwargs):
+    def __init__(self, fs=None, part_size: int = 2 ** 26, max_workers: int = 8,
+                 cache_dir: str = None, cache_size: int = 2 ** 30, project_id: str = None, **kwargs):
         super().__init__()
-        self.fs = gcsfs.GCSFileSystem(**kwargs)
-        self.project_id = google.auth.default()[1]
+        self._fs = fs
+        self._fs_kwargs = kwargs
+        self._project_id = project_id
+        self.init_lock = threading.Lock()
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.cache = _DiskCache(cache_dir, cache_size) if cache_dir else None
+
+    @property
+    def fs(self):
+        if self._fs is None:
+            with self.init_lock:
+                if self._fs is None:
+                    import gcsfs
+                    self._fs = gcsfs.GCSFileSystem(**self._fs_kwargs)
+        return self._fs
+
+    @property
+    def project_id(self) -> str:
+        if self._project_id is None:
+            with self.init_lock:
+                if self._project_id is None:
+                    import google.auth
+                    self._project_id = google.auth.default()[1]
+        return self._project_id
 
     def exists(self, location: str):
         return self.fs.exists(location)
@@ -21,21 +124,199 @@ class GCSStorer(IOStorer):
     def join(self, *args):
         return '/'.join([item for item in args])
 
+    def _read_ranges(self, location: str, buffer: memoryview):
+        """Download the ranges of a file concurrently into a preallocated buffer"""
+        def read_range(start: int):
+            end = min(start + self.part_size, len(buffer))
+            buffer[start: end] = self.fs.cat_file(location, start=start, end=end)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(read_range, range(0, len(buffer), self.part_size)))
+
+    def _get_cache_key(self, location: str) -> str:
+        """Cache key is derived from the path and the generation, so a rewritten file is a new key"""
+        info = self.fs.info(location)
+        generation = info.get('generation', None) or info.get('etag', '')
+        return hashlib.sha256('{}#{}'.format(location, generation).encode()).hexdigest()
+
+    def get_cache_stats(self) -> dict:
+        if self.cache is None:
+            return {}
+        with self.cache.lock:
+            return {'hits': self.cache.hits, 'misses': self.cache.misses,
+                    'files': len(self.cache.items), 'size': self.cache.size}
+
+    def _read_mapped(self, cache_path: str) -> bytes:
+        with open(cache_path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[:]
+
     def read(self, location: str) -> bytes:
+        if self.cache is None:
+            return self._read_remote(location)
+        cache_key = self._get_cache_key(location)
+        cache_path = self.cache.get(cache_key)
+        if cache_path is not None:
+            try:
+                return self._read_mapped(cache_path)
+            except FileNotFoundError as e:  # pragma: no cover
+                pass  # pragma: no cover
+        data = self._read_remote(location)
+        self.cache.put(cache_key, data)
+        return data
+
+    def _read_remote(self, location: str) -> bytes:
+        with self.fs.open(location, 'rb') as fp:
+            if fp.size <= self.part_size:
+                return fp.read()
+            size = fp.size
+        buffer = bytearray(size)
+        self._read_ranges(location, memoryview(buffer))
+        return bytes(buffer)
+
+    def _read_remote_into(self, location: str, buffer: memoryview = None) -> memoryview:
+        """Read a file into the given buffer (allocated when not given), returns the view of the file content"""
         with self.fs.open(location, 'rb') as fp:
-            return fp.read()
+            size = fp.size
+            if buffer is None:
+                buffer = memoryview(bytearray(size))
+            elif len(buffer) < size:
+                self.logger.error("Buffer of {} bytes too small for {}".format(len(buffer), location),
+                                  extra=self.log_context)
+                raise ValueError("XIA-010012")
+            if size <= self.part_size:
+                fp.readinto(buffer[:size])
+                return buffer[:size]
+        self._read_ranges(location, buffer[:size])
+        return buffer[:size]
+
+    def _map_file(self, cache_path: str) -> memoryview:
+        with open(cache_path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return memoryview(b'')
+            return memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def readinto(self, location: str, buffer) -> int:
+        """Read a file into a caller provided writable buffer
+
+        Returns:
+            size of the file
+        """
+        view = memoryview(buffer).cast('B')
+        cache_key = self._get_cache_key(location) if self.cache is not None else None
+        cache_path = self.cache.get(cache_key) if self.cache is not None else None
+        if cache_path is not None:
+            try:
+                with open(cache_path, 'rb') as fp:
+                    if len(view) < os.fstat(fp.fileno()).st_size:
+                        self.logger.error("Buffer of {} bytes too small for {}".format(len(view), location),
+                                          extra=self.log_context)
+                        raise ValueError("XIA-010012")
+                    return fp.readinto(view)
+            except FileNotFoundError as e:
+                pass
+        data_view = self._read_remote_into(location, view)
+        if cache_key is not None:
+            self.cache.put(cache_key, data_view)
+        return len(data_view)
+
+    def read_view(self, location: str) -> memoryview:
+        """Read a file as a read-only memoryview, mapped on the cached file when the disk cache is activated"""
+        cache_key = self._get_cache_key(location) if self.cache is not None else None
+        cache_path = self.cache.get(cache_key) if self.cache is not None else None
+        if cache_path is not None:
+            try:
+                return self._map_file(cache_path)
+            except FileNotFoundError as e:
+                pass
+        data = self._read_remote(location)
+        if cache_key is not None:
+            self.cache.put(cache_key, data)
+        return memoryview(data)
+
+    def _get_size(self, data_or_io) -> int:
+        if isinstance(data_or_io, memoryview):
+            return len(data_or_io)
+        if isinstance(data_or_io, io.IOBase) and data_or_io.seekable():
+            size = data_or_io.seek(0, io.SEEK_END)
+            data_or_io.seek(0)
+            return size
+        return 0
+
+    def _iter_parts(self, data_or_io):
+        if isinstance(data_or_io, memoryview):
+            for start in range(0, len(data_or_io), self.part_size):
+                yield data_or_io[start: start + self.part_size]
+        else:
+            data_or_io.seek(0)
+            part = data_or_io.read(self.part_size)
+            while part:
+                yield part
+                part = data_or_io.read(self.part_size)
+
+    def _write_parts(self, data_or_io, part_prefix: str, temp_paths: list) -> list:
+        """Upload the parts concurrently, at most max_workers parts are kept in memory"""
+        part_paths, futures = list(), set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for part_nb, part in enumerate(self._iter_parts(data_or_io)):
+                if len(futures) >= self.max_workers:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                part_path = '{}.part-0-{:05d}'.format(part_prefix, part_nb)
+                part_paths.append(part_path)
+                temp_paths.append(part_path)
+                futures.add(executor.submit(self.fs.pipe_file, part_path, part))
+            for future in futures:
+                future.result()
+        return part_paths
+
+    def _compose(self, location: str, part_prefix: str, part_paths: list, temp_paths: list):
+        """Compose the parts, lists longer than the compose limit are composed by levels"""
+        level = 0
+        while len(part_paths) > self.compose_limit:
+            level += 1
+            groups = [part_paths[i: i + self.compose_limit] for i in range(0, len(part_paths), self.compose_limit)]
+            part_paths = ['{}.part-{}-{:05d}'.format(part_prefix, level, i) for i in range(len(groups))]
+            temp_paths.extend(part_paths)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(self.fs.merge, part_paths, groups))
+        self.fs.merge(location, part_paths)
+
+    def _write_by_parts(self, data_or_io, location: str):
+        # Parts are named by a nonce of the writer, so concurrent writes of a location don't overwrite each other
+        part_prefix = '{}.{}'.format(location, uuid.uuid4().hex)
+        temp_paths = list()
+        try:
+            part_paths = self._write_parts(data_or_io, part_prefix, temp_paths)
+            self._compose(location, part_prefix, part_paths, temp_paths)
+        finally:
+            if temp_paths:
+                try:
+                    self.fs.rm(temp_paths)
+                except FileNotFoundError as e:  # pragma: no cover
+                    pass  # pragma: no cover
 
     def write(self, data_or_io, location: str) -> str:
-        if isinstance(data_or_io, io.IOBase):
+        """Write bytes, bytearray, memoryview or io object. In-memory data is sent without intermediate copies"""
+        if isinstance(data_or_io, io.BytesIO):
+            with data_or_io.getbuffer() as view:
+                return self.write(view, location)
+        if isinstance(data_or_io, (bytes, bytearray, memoryview)):
+            data_or_io = memoryview(data_or_io).cast('B')
+        if self._get_size(data_or_io) > self.part_size:
+            self._write_by_parts(data_or_io, location)
+        elif isinstance(data_or_io, memoryview):
+            self.fs.pipe_file(location, data_or_io)
+        elif isinstance(data_or_io, io.IOBase):
             with self.fs.open(location, 'wb') as fp:
                 data_or_io.seek(0)
                 chunk = data_or_io.read(2 ** 20)
                 while chunk:
                     fp.write(chunk)
                     chunk = data_or_io.read(2 ** 20)
-        elif isinstance(data_or_io, bytes):
-            with self.fs.open(location, 'wb') as fp:
-                fp.write(data_or_io)
         return location
 
     def remove(self, location: str) -> bool:
@@ -45,10 +326,80 @@ class GCSStorer(IOStorer):
         else:
             return False
 
+    def exists_many(self, locations: List[str]) -> List[bool]:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.fs.exists, locations))
+
+    def remove_many(self, locations: List[str]) -> List[bool]:
+        """Existing files are removed by batch delete requests
+
+        Returns:
+            for each location, True if the file was removed, False if it didn't exist
+        """
+        exist_list = self.exists_many(locations)
+        remove_list = [location for location, exist in zip(locations, exist_list) if exist]
+        if remove_list:
+            self.fs.rm(remove_list)
+        return exist_list
+
+    def read_many(self, locations: List[str]) -> List[bytes]:
+        """Returns:
+            for each location, content of the file or None if the file could not be read
+        """
+        if not locations:
+            return []
+        results = self.fs.cat(list(locations), on_error='return', batch_size=self.max_workers)
+        data_list = list()
+        for location in locations:
+            # Result keys are paths without protocol
+            result = results.get(self.fs._strip_protocol(location), results.get(location, None))
+            if isinstance(result, Exception):
+                self.logger.warning("Read {} failed: {}".format(location, result), extra=self.log_context)
+                result = None
+            data_list.append(result)
+        return data_list
+
+    def write_many(self, data_dict: Dict[str, object]) -> List[str]:
+        """Args:
+            data_dict: location as key, bytes or io object as value
+
+        Returns:
+            for each location, the location or None if the write failed
+        """
+        def write_item(location: str):
+            try:
+                return self.write(data_dict[location], location)
+            except Exception as e:
+                self.logger.warning("Write {} failed: {}".format(location, e), extra=self.log_context)
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(write_item, data_dict))
+
     def mkdir(self, path: str):
         pass
 
+    def _open_cached(self, cache_path: str):
+        """Open a cached file, None if it has been evicted in the meantime"""
+        if cache_path is None:
+            return None
+        try:
+            return open(cache_path, 'rb')
+        except FileNotFoundError as e:
+            return None
+
     def get_io_stream(self, location: str):
+        if self.cache is not None:
+            cache_key = self._get_cache_key(location)
+            fp = self._open_cached(self.cache.get(cache_key))
+            if fp is None:
+                data = self._read_remote(location)
+                self.cache.put(cache_key, data)
+                yield io.BytesIO(data)
+                return
+            with fp:
+                yield fp
+            return
         with self.fs.open(location, 'rb') as fp:
             yield fp
 